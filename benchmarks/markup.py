@@ -0,0 +1,115 @@
+# Vertaa yksivaiheista fixMarkup-kääntäjää aiempaan toteutukseen examples/-hakemiston sanoilla.
+# Käyttö: python benchmarks/markup.py [toistot]
+
+import glob
+import itertools
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from mango.document import MARKUP_CODE_DICT, MARKUP_CODE_LIST, fixMarkup
+
+# Aiempi toteutus sellaisenaan: jokainen tyylipari käydään läpi erikseen ja koodit korvataan lopuksi
+def legacyFixMarkup(text: str) -> str:
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    for open, close in MARKUP_CODE_LIST:
+        text = _balance(text, open, close)
+
+    text = _substituteMarkup(text)
+    return text
+
+def _balance(text: str, open: str, close: str) -> str:
+    i = 0
+    d = 0
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+            continue
+
+        if text[i:].startswith(open):
+            d += 1
+            i += len(open)
+
+        elif text[i:].startswith(close):
+            d -= 1
+            i += len(close)
+
+        else:
+            i += 1
+
+    while d > 0:
+        text += close
+        d -= 1
+
+    while d < 0:
+        text = open + text
+        d += 1
+
+    while open+close in text:
+        text = text.replace(open+close, "")
+
+    return text
+
+def _substituteMarkup(text: str) -> str:
+    ans = ""
+    i = 0
+    while i < len(text):
+        if text[i] == "\\":
+            ans += text[i+1]
+
+            i += 2
+
+        for code in itertools.chain(*MARKUP_CODE_LIST):
+            if text[i:].startswith(code):
+                ans += MARKUP_CODE_DICT[code]
+                i += len(code)
+                break
+        else:
+            ans += text[i]
+            i += 1
+
+    return ans
+
+def readWords() -> list:
+    words = []
+    for path in sorted(glob.glob(os.path.join(ROOT, "examples", "*"))):
+        with open(path, "r") as f:
+            for line in f:
+                words.extend(word for word in line.split() if word)
+
+    return words
+
+def measure(function, words: list, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for word in words:
+            try:
+                function(word)
+            except IndexError:
+                # Aiempi toteutus kaatuu, jos sana päättyy kenoviivaan
+                pass
+
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    words = readWords()
+    print(f"{len(words)} sanaa, {len(set(words))} erilaista")
+
+    legacy = measure(legacyFixMarkup, words, repeats)
+    cold = measure(fixMarkup.__wrapped__, words, repeats)
+    fixMarkup.cache_clear()
+    memoized = measure(fixMarkup, words, repeats)
+
+    print(f"Aiempi toteutus:       {legacy*1000:8.2f} ms")
+    print(f"Uusi ilman muistia:    {cold*1000:8.2f} ms ({legacy/cold:.1f}x)")
+    print(f"Uusi muistin kanssa:   {memoized*1000:8.2f} ms ({legacy/memoized:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+# Mittaa koko taittoputken vaiheet synteettisillä dokumenteilla kaikissa syötemuodoissa.
+# Jokainen tapaus ajetaan omassa prosessissaan, jotta muistin huippukäyttö on vertailukelpoinen.
+# Käyttö: python benchmarks/pipeline.py [--sizes 10 100 1000 10000] [--formats txt mng json] [-o raportti.json]
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from mango import __version__
+from mango.document import MARKUP_CODES, evalScript, jsonToDocument, parseDocument
+from mango.params import Parameters
+from mango.render import LineMetrics, draw
+
+FORMATS = ["txt", "mng", "json"]
+SIZES = [10, 100, 1000, 10000]
+STAGES = ["parse", "hyphenation", "layout", "page_breaks", "drawing"]
+
+WORDS = [
+    "taitto", "kirja", "sivu", "rivi", "sana", "ja", "on", "että", "mutta", "kun", "se", "hän",
+    "kappale", "otsikko", "kirjain", "fontti", "teksti", "leveys", "korkeus", "väli",
+]
+
+# Pitkät yhdyssanat pakottavat tavuttamaan rivin lopussa
+LONG_WORDS = [
+    "järjestelmäkehitysprojektin", "ympäristönsuojelulainsäädäntö", "kansalaisvaikuttamismahdollisuuksien",
+    "tietojenkäsittelytieteellisessä", "lentokonesuihkuturbiinimoottoriapumekaanikko",
+    "epäjärjestelmällistyttämättömyydellänsä", "kaksikymmentäseitsemänvuotiaana", "yliopistokoulutusohjelmasta",
+]
+
+MARKUP = [("*{", "}*"), ("[", "]"), ("%{", "}%"), ("^{", "}^"), ("_{", "}_")]
+
+SPLITCHARS = "󰕯󰝙󰢏󰔳󰞓󰧄󰎄󰚣󰕷󰄇󰣼󰃻󰍱󰓍󰕠󰉁󰦃󰧤󰑟󰑚"
+
+# Synteettinen dokumentti on lista lukuja, joiden kappaleet ovat pareja (tyyppi, sisältö)
+Item = Tuple[str, object]
+
+def sentence(rng: random.Random, words: int) -> str:
+    ans = []
+    for _ in range(words):
+        word = rng.choice(LONG_WORDS) if rng.random() < 0.15 else rng.choice(WORDS)
+        if rng.random() < 0.05:
+            open, close = rng.choice(MARKUP)
+            word = open + word + close
+
+        ans.append(word)
+
+    return " ".join(ans).capitalize() + "."
+
+def generateDocument(size: int, seed: int = 0) -> List[List[Item]]:
+    rng = random.Random(seed)
+    chapters: List[List[Item]] = [[]]
+    for i in range(size):
+        if i and i % 200 == 0:
+            chapters.append([])
+
+        r = rng.random()
+        if i % 25 == 0:
+            chapters[-1].append(("title" if i % 200 == 0 else "subtitle", sentence(rng, rng.randint(2, 5))))
+
+        elif r < 0.08:
+            columns = rng.randint(2, 4)
+            chapters[-1].append(("table", [[sentence(rng, rng.randint(1, 6)) for _ in range(columns)] for _ in range(rng.randint(2, 5))]))
+
+        elif r < 0.12:
+            chapters[-1].append(("splitchars", "".join(rng.choice(SPLITCHARS) for _ in range(rng.randint(20, 80)))))
+
+        else:
+            chapters[-1].append(("text", " ".join(sentence(rng, rng.randint(5, 20)) for _ in range(rng.randint(1, 6)))))
+
+    return chapters
+
+def splitchars(string: str) -> str:
+    # Sama muunnos kuin .mng-skriptien splitchars-funktiossa
+    string = " ".join(string)
+    for open, close in MARKUP_CODES.keys():
+        string = string.replace(" ".join(open), open)
+        string = string.replace(" ".join(close), close)
+
+    return string
+
+def toText(chapters: List[List[Item]]) -> str:
+    ans = []
+    for i, chapter in enumerate(chapters):
+        if i:
+            ans.append("\\newpage\n")
+
+        for type, content in chapter:
+            if type == "table":
+                ans.append("\\tablestart\n" + "".join(" | ".join(row) + "\n" for row in content) + "\\tablestop\n")
+
+            elif type == "splitchars":
+                ans.append(splitchars(content) + "\n")
+
+            elif type == "text":
+                ans.append(content + "\n")
+
+            else:
+                ans.append(f"\\{type} {content}\n")
+
+    return "\n".join(ans)
+
+def toScript(chapters: List[List[Item]]) -> str:
+    ans = []
+    for i, chapter in enumerate(chapters):
+        if i:
+            ans.append("newpage()\n")
+
+        for type, content in chapter:
+            if type == "table":
+                ans.append("tablestart()\n" + "nextrow()\n".join("".join(f"pg:| {cell}\n" for cell in row) for row in content) + "tablestop()\n")
+
+            elif type == "splitchars":
+                ans.append(f"pg:splitchars:| {content}\n")
+
+            elif type == "text":
+                ans.append(f"pg:| {content}\n")
+
+            else:
+                ans.append(f"{type}:| {content}\n")
+
+    return "".join(ans)
+
+def toJson(chapters: List[List[Item]]) -> str:
+    ans = []
+    for chapter in chapters:
+        jchapter = []
+        for type, content in chapter:
+            if type == "table":
+                jchapter.append({"type": "table", "rows": [[{"text": cell} for cell in row] for row in content]})
+
+            elif type == "splitchars":
+                jchapter.append({"text": splitchars(content)})
+
+            else:
+                jchapter.append({"type": type, "text": content})
+
+        ans.append(jchapter)
+
+    return json.dumps(ans, ensure_ascii=False)
+
+SERIALIZERS = {"txt": toText, "mng": toScript, "json": toJson}
+PARSERS = {"txt": parseDocument, "mng": evalScript, "json": jsonToDocument}
+
+def loadArgs(cache_dir: str, options: List[str]) -> argparse.Namespace:
+    # Asetukset luetaan komentorivikäyttöliittymän jäsentimellä, jotta oletusarvot ovat samat
+    spec = importlib.util.spec_from_file_location("mango_cli", os.path.join(ROOT, "mango.py"))
+    cli = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cli)
+    return cli.parseArgs(["-", os.devnull, "--cache_dir", cache_dir, *options])
+
+def peakMemory() -> int:
+    # Linuxissa ru_maxrss on kilotavuina
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def runCase(input_format: str, size: int, options: List[str]) -> Dict[str, object]:
+    source = SERIALIZERS[input_format](generateDocument(size))
+    times: Dict[str, float] = {stage: 0.0 for stage in STAGES}
+    memory: Dict[str, int] = {}
+    lines_total = 0
+    pages_total = 0
+
+    with tempfile.TemporaryDirectory(prefix="mango-bench-") as cache_dir, contextlib.redirect_stdout(io.StringIO()):
+        args = loadArgs(cache_dir, options)
+
+        start = time.perf_counter()
+        chapters = PARSERS[input_format](source)
+        times["parse"] = time.perf_counter() - start
+        memory["parse"] = peakMemory()
+
+        # Piirtäjän tila alustetaan kuten draw.render tekee, mutta vaiheet ajetaan erikseen
+        drawer = draw(args)
+        drawer.params = Parameters(args)
+        drawer.param_stack = []
+        drawer.openSurface(None, args.width, args.height)
+
+        start = time.perf_counter()
+        drawer.hyphenation.prepare(drawer.params, chapters)
+        times["hyphenation"] = time.perf_counter() - start
+        memory["hyphenation"] = peakMemory()
+
+        for chapter in chapters:
+            start = time.perf_counter()
+            lines = drawer.paragraphsToLines(chapter)
+            times["layout"] += time.perf_counter() - start
+            memory["layout"] = peakMemory()
+
+            start = time.perf_counter()
+            metrics = LineMetrics.fromLines(lines)
+            bps = drawer.calculatePageBreaks(metrics)
+            times["page_breaks"] += time.perf_counter() - start
+            memory["page_breaks"] = peakMemory()
+
+            start = time.perf_counter()
+            for i, j in zip([0] + bps, bps + [len(lines)+1]):
+                drawer.drawPage(lines[i:j], metrics[i:j], j == len(lines) + 1)
+
+            if drawer.page%2 == 0:
+                drawer.showPage()
+
+            times["drawing"] += time.perf_counter() - start
+            memory["drawing"] = peakMemory()
+
+            lines_total += len(lines)
+            pages_total += len(bps) + 1
+
+        start = time.perf_counter()
+        drawer.surf.finish()
+        times["drawing"] += time.perf_counter() - start
+        drawer.close()
+
+    return {
+        "format": input_format,
+        "paragraphs": size,
+        "chapters": len(chapters),
+        "input_bytes": len(source.encode("utf-8")),
+        "lines": lines_total,
+        "pages": pages_total,
+        "seconds": times,
+        "peak_rss_kb": memory,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--formats", choices=FORMATS, nargs="+", default=FORMATS)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("-o", "--output", help="JSON-raportin tiedosto")
+    parser.add_argument("mango_options", nargs=argparse.REMAINDER, help="mango.py:n asetukset -- -merkin jälkeen")
+    args = parser.parse_args()
+    options = args.mango_options[1:] if args.mango_options[:1] == ["--"] else args.mango_options
+
+    results = []
+    ctx = multiprocessing.get_context("fork")
+    print(f"{'muoto':>6} {'kappaleita':>10} " + " ".join(f"{stage:>12}" for stage in STAGES) + f" {'muisti (MB)':>12}")
+    for size in args.sizes:
+        for input_format in args.formats:
+            best = None
+            for _ in range(args.repeats):
+                # Uusi prosessi jokaiselle ajolle, jotta välimuistit ja muistin huippu eivät periydy
+                with ctx.Pool(1) as pool:
+                    result = pool.apply(runCase, (input_format, size, options))
+
+                if best is None:
+                    best = result
+
+                else:
+                    for stage in STAGES:
+                        best["seconds"][stage] = min(best["seconds"][stage], result["seconds"][stage])
+                        best["peak_rss_kb"][stage] = max(best["peak_rss_kb"][stage], result["peak_rss_kb"][stage])
+
+            results.append(best)
+            print(f"{input_format:>6} {size:>10} " + " ".join(f"{best['seconds'][stage]*1000:10.1f}ms" for stage in STAGES) + f" {best['peak_rss_kb']['drawing']/1024:12.1f}")
+
+    report = {
+        "mango_version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "repeats": args.repeats,
+        "options": options,
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+        print(f"Raportti kirjoitettu tiedostoon {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
 import argparse
+import json
 import math
-from os import sysconf
+import os
+import sys
+import time
+import traceback
+from typing import Callable, Iterable, Iterator, List, Optional
 
-from mango.document import evalScript, jsonToDocument, parseDocument
-from mango.render import draw
+from mango.document import Chapter, evalScript, iterDocument, iterJsonLines, jsonToDocument
+from mango.displaylist import DisplayList
+from mango.render import draw, renderDisplayList
+from mango.script import Profiler
+from mango.stats import Stats
 
 PAGESIZES = {
     "A0": (841, 1189),
@@ -41,18 +49,137 @@ PAGESIZES = {
     "C10": (28, 40),
 }
 
-def main():
+INPUT_FORMATS = {
+    ".json": "json",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".mng": "mng",
+}
+
+def inputFormat(infile: str, input_format: str) -> str:
+    if input_format != "auto":
+        return input_format
+    
+    return INPUT_FORMATS.get(os.path.splitext(infile)[1], "txt")
+
+def streamDocument(infile: str, parse: Callable[[Iterable[str]], Iterator[Chapter]]) -> Iterator[Chapter]:
+    if infile == "-":
+        yield from parse(sys.stdin)
+    
+    else:
+        with open(infile, "r") as f:
+            yield from parse(f)
+
+def readDocument(infile: str, input_format: str = "auto", profile_script: Optional[str] = None) -> Iterable[Chapter]:
+    # Teksti- ja NDJSON-dokumentit luetaan luku kerrallaan piirron edetessä
+    input_format = inputFormat(infile, input_format)
+    if input_format == "txt":
+        return streamDocument(infile, iterDocument)
+    
+    elif input_format == "ndjson":
+        return streamDocument(infile, iterJsonLines)
+    
+    if infile == "-":
+        text = sys.stdin.read()
+    
+    else:
+        with open(infile, "r") as f:
+            text = f.read()
+    
+    if input_format == "json":
+        return jsonToDocument(text)
+    
+    if profile_script is None:
+        return evalScript(text)
+    
+    profiler = Profiler(text)
+    chapters = evalScript(text, profiler)
+    writeProfile(profiler, profile_script)
+    return chapters
+
+def writeProfile(profiler: Profiler, path: str):
+    if path == "-":
+        profiler.printTable()
+    
+    else:
+        with open(path, "w") as f:
+            json.dump(profiler.toJson(), f, indent=2, ensure_ascii=False)
+        
+        print(f"Skriptin profiili tallennettu tiedostoon {path}")
+
+def writeStats(stats: Stats, path: str):
+    if path == "-":
+        stats.printTable()
+    
+    else:
+        with open(path, "w") as f:
+            json.dump(stats.toJson(), f, indent=2)
+        
+        print(f"Tilastot tallennettu tiedostoon {path}")
+
+def watch(args: argparse.Namespace):
+    # Piirtäjä pysyy käynnissä, joten fontit, mittaukset, tavutukset ja muuttumattomat luvut ovat valmiina
+    renderer = draw(args)
+    mtime = None
+    try:
+        while True:
+            try:
+                current = os.stat(args.infile).st_mtime_ns
+            except FileNotFoundError:
+                current = mtime
+
+            if current != mtime:
+                mtime = current
+                start = time.perf_counter()
+                try:
+                    renderer.render(readDocument(args.infile, args.input_format, args.profile_script))
+                    print(f"Piirretty {time.perf_counter() - start:.2f} sekunnissa, odotetaan muutoksia...")
+                except Exception:
+                    traceback.print_exc()
+
+            time.sleep(args.watch_interval)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        renderer.close()
+
+def parseArgs(argv: Optional[List[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument("infile", nargs="?", default="-")
     parser.add_argument("outfile")
+    parser.add_argument("--input_format", choices=["auto", "txt", "mng", "json", "ndjson"], default="auto")
     parser.add_argument("--page_size", default="A4")
     parser.add_argument("--width", type=float, default=0)
     parser.add_argument("--height", type=float, default=0)
     parser.add_argument("--margin", type=float, default=50)
     parser.add_argument("--font", default="Sans")
     parser.add_argument("--page_dir", default="v")
+    parser.add_argument("--page_break_lookahead", type=float, default=0)
+    parser.add_argument("--shape_paragraphs", action="store_true")
+    parser.add_argument("--direct_paint", action="store_true")
+    parser.add_argument("--layout_workers", type=int, default=0)
+    parser.add_argument("--chapter_workers", type=int, default=0)
+    parser.add_argument("--metrics_cache_size", type=int, default=10000)
+    parser.add_argument("--hyphenator", choices=["voikko", "patterns", "none"], default="voikko")
+    parser.add_argument("--hyphenation_language", default="fi")
+    parser.add_argument("--hyphenation_patterns", default="")
+    parser.add_argument("--layout_cache", action="store_true")
+    parser.add_argument("--layout_cache_size", type=int, default=256)
+    parser.add_argument("--cache_dir", default=os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "mango"))
+    parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--watch_interval", type=float, default=0.2)
     parser.add_argument("--debug", action="store_true")
-    args = parser.parse_args()
+    parser.add_argument("--profile_script", nargs="?", const="-", metavar="JSON_FILE")
+    parser.add_argument("--stats_json", nargs="?", const="-", metavar="JSON_FILE")
+    args = parser.parse_args(argv)
+
+    if args.watch and args.infile == "-":
+        parser.error("--watch needs an input file")
+    
+    if args.watch and args.stats_json is not None:
+        parser.error("--stats_json cannot be used with --watch")
 
     if args.page_size:
         if args.page_size in PAGESIZES:
@@ -64,24 +191,30 @@ def main():
 
     if not args.page_dir in "v^":
         args.width, args.height = args.height, args.width
-
-    if args.infile == "-":
-        text = sysconf.stdin.read()
     
-    else:
-        with open(args.infile, "r") as f:
-            text = f.read()
+    return args
+
+def main():
+    args = parseArgs()
+
+    if args.infile.endswith(".mngd"):
+        with open(args.infile, "rb") as f:
+            renderDisplayList(DisplayList.read(f), args.outfile)
     
-    if args.infile.endswith(".json"):
-        chapters = jsonToDocument(text)
+    elif args.watch:
+        watch(args)
     
-    elif args.infile.endswith(".mng"):
-        chapters = evalScript(text)
+    elif args.stats_json is not None:
+        stats = Stats()
+        # Kerralla luettavat muodot jäsennetään jo tässä, virtaavien muotojen luvut piirron aikana
+        start = time.perf_counter()
+        chapters = readDocument(args.infile, args.input_format, args.profile_script)
+        stats.add("parse", time.perf_counter() - start)
+        draw(args, chapters, stats)
+        writeStats(stats, args.stats_json)
     
     else:
-        chapters = parseDocument(text)
-
-    draw(args, chapters)
+        draw(args, readDocument(args.infile, args.input_format, args.profile_script))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
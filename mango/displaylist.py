@@ -0,0 +1,167 @@
+import struct
+from typing import BinaryIO, Dict, List, NamedTuple, Tuple, Union
+
+from .metrics import FontKey
+
+# Tiedostomuoto: otsake, merkkijonotaulu, fonttitaulu, sivut komentoineen ja sisällysluettelo.
+# Kaikki luvut ovat little-endian-muodossa.
+MAGIC = b"MNGD"
+VERSION = 1
+
+OP_TEXT = 1
+OP_TABS = 2
+OP_RULE = 3
+
+NO_FAMILY = 0xFFFFFFFF
+
+class Outline(NamedTuple):
+    level: int
+    title: str
+    page: int
+    x: float
+    y: float
+
+class TextRun(NamedTuple):
+    font: int
+    x: float
+    y: float
+    markup: str
+
+class TabRun(NamedTuple):
+    font: int
+    x: float
+    y: float
+    words: List[Tuple[float, str]]
+
+class Rule(NamedTuple):
+    x1: float
+    y1: float
+    x2: float
+    y2: float
+    gray: float
+
+Op = Union[TextRun, TabRun, Rule]
+
+class DisplayList:
+    def __init__(self, width: float, height: float):
+        self.width = width
+        self.height = height
+        self.fonts: List[FontKey] = []
+        self.font_indices: Dict[FontKey, int] = {}
+        self.pages: List[List[Op]] = []
+        self.ops: List[Op] = []
+        self.outlines: List[Outline] = []
+
+    def fontIndex(self, font: FontKey) -> int:
+        if font not in self.font_indices:
+            self.font_indices[font] = len(self.fonts)
+            self.fonts.append(font)
+
+        return self.font_indices[font]
+
+    def showPage(self):
+        self.pages.append(self.ops)
+        self.ops = []
+
+    def write(self, f: BinaryIO):
+        strings: List[str] = []
+        string_indices: Dict[str, int] = {}
+
+        def ref(text: str) -> int:
+            if text not in string_indices:
+                string_indices[text] = len(strings)
+                strings.append(text)
+
+            return string_indices[text]
+
+        body = bytearray()
+        body += struct.pack("<I", len(self.fonts))
+        for family, size in self.fonts:
+            body += struct.pack("<Ii", NO_FAMILY if family is None else ref(family), size)
+
+        body += struct.pack("<I", len(self.pages))
+        for page in self.pages:
+            body += struct.pack("<I", len(page))
+            for op in page:
+                if isinstance(op, TextRun):
+                    body += struct.pack("<BIffI", OP_TEXT, op.font, op.x, op.y, ref(op.markup))
+
+                elif isinstance(op, TabRun):
+                    body += struct.pack("<BIffI", OP_TABS, op.font, op.x, op.y, len(op.words))
+                    for x, markup in op.words:
+                        body += struct.pack("<fI", x, ref(markup))
+
+                else:
+                    body += struct.pack("<Bfffff", OP_RULE, *op)
+
+        body += struct.pack("<I", len(self.outlines))
+        for outline in self.outlines:
+            body += struct.pack("<iIIdd", outline.level, ref(outline.title), outline.page, outline.x, outline.y)
+
+        f.write(struct.pack("<4sHdd", MAGIC, VERSION, self.width, self.height))
+        f.write(struct.pack("<I", len(strings)))
+        for text in strings:
+            data = text.encode("utf-8")
+            f.write(struct.pack("<I", len(data)))
+            f.write(data)
+
+        f.write(body)
+
+    @staticmethod
+    def read(f: BinaryIO) -> "DisplayList":
+        data = f.read()
+        pos = 0
+
+        def unpack(fmt: str) -> tuple:
+            nonlocal pos
+            ans = struct.unpack_from(fmt, data, pos)
+            pos += struct.calcsize(fmt)
+            return ans
+
+        magic, version, width, height = unpack("<4sHdd")
+        if magic != MAGIC:
+            raise RuntimeError("Not a Mango display list")
+
+        if version != VERSION:
+            raise RuntimeError(f"Unsupported display list version {version}")
+
+        strings = []
+        for _ in range(unpack("<I")[0]):
+            length, = unpack("<I")
+            strings.append(data[pos:pos+length].decode("utf-8"))
+            pos += length
+
+        dl = DisplayList(width, height)
+        for _ in range(unpack("<I")[0]):
+            family, size = unpack("<Ii")
+            dl.fontIndex((None if family == NO_FAMILY else strings[family], size))
+
+        for _ in range(unpack("<I")[0]):
+            for _ in range(unpack("<I")[0]):
+                code, = unpack("<B")
+                if code == OP_TEXT:
+                    font, x, y, markup = unpack("<IffI")
+                    dl.ops.append(TextRun(font, x, y, strings[markup]))
+
+                elif code == OP_TABS:
+                    font, x, y, n = unpack("<IffI")
+                    words = []
+                    for _ in range(n):
+                        wx, markup = unpack("<fI")
+                        words.append((wx, strings[markup]))
+
+                    dl.ops.append(TabRun(font, x, y, words))
+
+                elif code == OP_RULE:
+                    dl.ops.append(Rule(*unpack("<fffff")))
+
+                else:
+                    raise RuntimeError(f"Unknown display list operation {code}")
+
+            dl.showPage()
+
+        for _ in range(unpack("<I")[0]):
+            level, title, page, x, y = unpack("<iIIdd")
+            dl.outlines.append(Outline(level, strings[title], page, x, y))
+
+        return dl
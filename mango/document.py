@@ -1,10 +1,13 @@
+import collections
+import functools
+import io
 import itertools
 import json
 import re
-from typing import Callable, Dict, List, Literal, NamedTuple, Tuple, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Literal, NamedTuple, Optional, Tuple, Union
 
 from .params import Parameters
-from .script import Interpreter, lexer, parseBlock
+from .script import Interpreter, Profiler, compileScript
 
 
 class Paragraph(NamedTuple):
@@ -14,8 +17,7 @@ class Paragraph(NamedTuple):
 
     @staticmethod
     def fromText(text, type="text", no_page_break=False):
-        text = substituteCharacterEscapes(text)
-        text = addBalance(text)
+        text = prepareText(text)
         return Paragraph(text=text.strip(), type=type, no_page_break=no_page_break)
 
 class Table(NamedTuple):
@@ -46,40 +48,6 @@ def jsonToDocument(code: str) -> List[Chapter]:
     elif jdoc and not isinstance(jdoc[0], list):
         jdoc = [jdoc]
     
-    def jsonToDocumentObj(jpg):
-        if not isinstance(jpg, dict):
-            raise RuntimeError("Paragraphs must be JSON objects")
-
-        pg_type = jpg.get("type", "text")
-        if pg_type in {"title", "subtitle", "subsubtitle", "subsubsubtitle", "text"}:
-            return Paragraph.fromText(text=jpg.get("text"), type=pg_type, no_page_break=not jpg.get("page_break", True))
-        
-        elif pg_type == "table":
-            rows = []
-            for jrow in jpg.get("rows"):
-                cols = []
-                for jcol in jrow:
-                    cols.append(jsonToDocumentObj(jcol))
-                
-                rows.append(cols)
-            
-            return Table(rows=rows, no_page_break=not jpg.get("page_break", True))
-        
-        elif pg_type == "vspace":
-            return VSpace(jpg.get("height", 0), no_page_break=not jpg.get("page_break", True))
-        
-        elif pg_type == "set":
-            var = jpg["param"]
-            val = jpg["value"]
-
-            return Eval(lambda params: setattr(params, var, val))
-        
-        elif pg_type == "subenv":
-            return Subenvironment([jsonToDocumentObj(pg) for pg in jpg["pgs"]])
-        
-        else:
-            raise RuntimeError("Unknown document object type " + repr(pg_type))
-    
     ans: List[Chapter] = []
     for jchapter in jdoc:
         chapter: Chapter = []
@@ -90,11 +58,69 @@ def jsonToDocument(code: str) -> List[Chapter]:
     
     return ans
 
-def evalScript(code: str) -> List[Chapter]:
+def jsonToDocumentObj(jpg) -> DocumentObj:
+    if not isinstance(jpg, dict):
+        raise RuntimeError("Paragraphs must be JSON objects")
+
+    pg_type = jpg.get("type", "text")
+    if pg_type in {"title", "subtitle", "subsubtitle", "subsubsubtitle", "text"}:
+        return Paragraph.fromText(text=jpg.get("text"), type=pg_type, no_page_break=not jpg.get("page_break", True))
+    
+    elif pg_type == "table":
+        rows = []
+        for jrow in jpg.get("rows"):
+            cols = []
+            for jcol in jrow:
+                cols.append(jsonToDocumentObj(jcol))
+            
+            rows.append(cols)
+        
+        return Table(rows=rows, no_page_break=not jpg.get("page_break", True))
+    
+    elif pg_type == "vspace":
+        return VSpace(jpg.get("height", 0), no_page_break=not jpg.get("page_break", True))
+    
+    elif pg_type == "set":
+        var = jpg["param"]
+        val = jpg["value"]
+
+        return Eval(lambda params: setattr(params, var, val))
+    
+    elif pg_type == "subenv":
+        return Subenvironment([jsonToDocumentObj(pg) for pg in jpg["pgs"]])
+    
+    else:
+        raise RuntimeError("Unknown document object type " + repr(pg_type))
+
+def iterJsonLines(f: Iterable[str]) -> Iterator[Chapter]:
+    # Jokaisella rivillä on yksi kappaleolio. Luvut erotetaan rivillä {"type": "newpage"}.
+    chapter: Chapter = []
+    for i, line in enumerate(f):
+        if not line.strip():
+            continue
+        
+        try:
+            jpg = json.loads(line)
+        except ValueError as e:
+            raise RuntimeError(f"Invalid JSON on line {i+1}: {e}")
+        
+        if isinstance(jpg, dict) and jpg.get("type") == "newpage":
+            if chapter:
+                yield chapter
+            
+            chapter = []
+        
+        else:
+            chapter.append(jsonToDocumentObj(jpg))
+    
+    if chapter:
+        yield chapter
+
+def evalScript(code: str, profiler: Optional[Profiler] = None) -> List[Chapter]:
     chapters: List[Chapter] = []
     current_chapter_stack: List[List[DocumentObj]] = [[]]
     
-    itpt = Interpreter()
+    itpt = Interpreter(profiler)
     fs = itpt.frames[-1].functions
 
     def pgf(type):
@@ -170,24 +196,31 @@ def evalScript(code: str) -> List[Chapter]:
 
     fs["splitchars"] = splitchars
 
-    tokens = lexer(code)
-    #print(tokens)
-    tree = parseBlock(tokens)
-    #print(tree)
-    tree.eval(itpt)
+    compileScript(code, profiler is not None)(itpt)
 
     newPage()
 
     return chapters
 
 def parseDocument(text: str) -> List[Chapter]:
-    lines = text.split("\n")
-    ans: List[List[str]] = []
-    chapter = []
-    for line in lines:
+    return list(iterDocument(io.StringIO(text)))
+
+def _iterLines(f: Iterable[str]) -> Iterator[str]:
+    # Rivit jaetaan kuten str.split("\n"): rivinvaihtoon päättyvän tekstin lopussa on tyhjä rivi
+    line = ""
+    for line in f:
+        yield line[:-1] if line.endswith("\n") else line
+    
+    if line == "" or line.endswith("\n"):
+        yield ""
+
+def iterDocument(f: Iterable[str]) -> Iterator[Chapter]:
+    # Luvut jäsennetään sitä mukaa kuin niitä luetaan, joten muistissa on kerrallaan vain yksi luku
+    chapter: List[str] = []
+    for line in _iterLines(f):
         if line.strip() == "\\newpage":
             if chapter:
-                ans.append(chapter)
+                yield parseChapter(chapter)
             
             chapter = []
         
@@ -195,11 +228,10 @@ def parseDocument(text: str) -> List[Chapter]:
             chapter.append(line)
     
     if chapter:
-        ans.append(chapter)
-    
-    return [parseChapter(c) for c in ans]
+        yield parseChapter(chapter)
 
-def parseChapter(lines: List[str]) -> Chapter:
+def parseChapter(chapter_lines: List[str]) -> Chapter:
+    lines = collections.deque(chapter_lines)
     pgs: List[DocumentObj] = []
     partial = ""
     npb = False
@@ -299,11 +331,11 @@ def parseChapter(lines: List[str]) -> Chapter:
         elif line == "\\tablestart":
             parseParagraph()
             rows = []
-            line = lines.pop(0).strip()
+            line = lines.popleft().strip()
             while lines and line != "\\tablestop":
                 columns = [Paragraph.fromText(text=c) for c in line.split("|")]
                 rows.append(columns)
-                line = lines.pop(0).strip()
+                line = lines.popleft().strip()
             
             pgs.append(Table(rows=rows, no_page_break=npb))
             npb = False
@@ -321,7 +353,7 @@ def parseChapter(lines: List[str]) -> Chapter:
             partial += " " + line
 
     while lines:
-        line = lines.pop(0).strip()
+        line = lines.popleft().strip()
         parseLine(line)
         
     parseParagraph()
@@ -346,120 +378,119 @@ MARKUP_CODES: Dict[Tuple[str, str], Tuple[str, str]] = {
 MARKUP_CODE_DICT = {m: c for k, v in MARKUP_CODES.items() for m, c in zip(k, v)}
 MARKUP_CODE_LIST = list(sorted(MARKUP_CODES, key=lambda t: -len(t[0])))
 
-def fixMarkup(text: str) -> str:
-    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-    for open, close in MARKUP_CODE_LIST:
-        text = _balance(text, open, close)
-    
-    text = _substituteMarkup(text)
-    return text
-
-def _balance(text: str, open: str, close: str) -> str:
-    i = 0
-    d = 0
-    while i < len(text):
-        if text[i] == "\\":
-            i += 2
-            continue
+# Merkintäkoodit tunnistetaan samassa järjestyksessä kuin MARKUP_CODE_LIST ne luettelee
+MARKUP_CODE_PAIRS = {code: (pair, code == codes[0]) for pair, codes in enumerate(MARKUP_CODE_LIST) for code in codes}
+MARKUP_OPEN_TAGS = [MARKUP_CODES[codes][0] for codes in MARKUP_CODE_LIST]
+MARKUP_CLOSE_TAGS = [MARKUP_CODES[codes][1] for codes in MARKUP_CODE_LIST]
+MARKUP_TOKEN_RE = re.compile(r"\\(.?)|(" + "|".join(re.escape(code) for code in itertools.chain(*MARKUP_CODE_LIST)) + r")|([^\\*}~^_%$\[\]]+|.)", re.S)
 
-        if text[i:].startswith(open):
-            d += 1
-            i += len(open)
-        
-        elif text[i:].startswith(close):
-            d -= 1
-            i += len(close)
+def _escapeXml(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+@functools.lru_cache(maxsize=65536)
+def fixMarkup(text: str) -> str:
+    # Ensimmäinen läpikäynti jakaa tekstin osiin ja laskee, montako parittonta sulkevaa koodia kullakin
+    # tyylillä on. Niitä vastaavat tyylit avataan tekstin alussa ja parittomat avaavat suljetaan lopussa.
+    tokens: List[Union[str, Tuple[int, bool]]] = []
+    depth = [0] * len(MARKUP_CODE_LIST)
+    missing = [0] * len(MARKUP_CODE_LIST)
+    for escaped, code, plain in MARKUP_TOKEN_RE.findall(text):
+        if code:
+            pair, opening = MARKUP_CODE_PAIRS[code]
+            if opening:
+                depth[pair] += 1
+            
+            else:
+                depth[pair] -= 1
+                if -depth[pair] > missing[pair]:
+                    missing[pair] = -depth[pair]
+            
+            tokens.append((pair, opening))
         
-        else:
-            i += 1
-    
-    while d > 0:
-        text += close
-        d -= 1
-    
-    while d < 0:
-        text = open + text
-        d += 1
+        elif escaped or plain:
+            tokens.append(_escapeXml(escaped or plain))
     
-    while open+close in text:
-        text = text.replace(open+close, "")
-    
-    return text
-
-def _substituteMarkup(text: str) -> str:
-    ans = ""
-    i = 0
-    while i < len(text):
-        if text[i] == "\\":
-            ans += text[i+1]
-
-            i += 2
+    # Toinen läpikäynti pitää tyylit pinossa, jotta Pango-tagit ovat aina oikein sisäkkäin:
+    # toisen tyylin sisällä suljettu tyyli sulkee ja avaa uudelleen väliin jäävät tyylit.
+    # Tyhjät tyylit jätetään pois.
+    ans: List[str] = []
+    stack: List[Tuple[int, int]] = []
+
+    def openStyle(pair: int):
+        stack.append((pair, len(ans)))
+        ans.append(MARKUP_OPEN_TAGS[pair])
+
+    def closeStyle():
+        pair, start = stack.pop()
+        if start == len(ans) - 1:
+            ans.pop()
         
-        for code in itertools.chain(*MARKUP_CODE_LIST):
-            if text[i:].startswith(code):
-                ans += MARKUP_CODE_DICT[code]
-                i += len(code)
-                break
         else:
-            ans += text[i]
-            i += 1
-    
-    return ans
+            ans.append(MARKUP_CLOSE_TAGS[pair])
 
-def substituteCharacterEscapes(text: str) -> str:
-    ans = ""
-    i = 0
-    while i < len(text):
-        if text[i] == "\\":
-            if text[i+1] == "n":
-                ans += "\n"
-                i += 2
-                continue
-
-            ans += text[i:i+2]
-            i += 2
-            continue
-        
-        ans += text[i]
-        i += 1
+    for pair in reversed(range(len(MARKUP_CODE_LIST))):
+        for _ in range(missing[pair]):
+            openStyle(pair)
     
-    return ans
-
-def addBalance(text: str) -> str:
-    words = text.split(" ")
-    new_words = []
-    balance = ""
-    for word in words:
-        word = balance + word
-        balance = getBalance(word)
-        new_words.append(word)
+    for token in tokens:
+        if isinstance(token, str):
+            ans.append(token)
+        
+        elif token[1]:
+            openStyle(token[0])
+        
+        else:
+            reopen = []
+            while stack[-1][0] != token[0]:
+                reopen.append(stack[-1][0])
+                closeStyle()
+            
+            closeStyle()
+            for pair in reversed(reopen):
+                openStyle(pair)
     
-    return " ".join(new_words)
-
-def getBalance(text: str) -> str:
-    ans = ""
-    for open, close in MARKUP_CODE_LIST:
-        ans += _getBalance(text, open, close)
+    while stack:
+        closeStyle()
     
-    return ans
-
-def _getBalance(text: str, open: str, close: str) -> str:
-    i = 0
-    d = 0
-    while i < len(text):
-        if text[i] == "\\":
-            i += 2
-            continue
-
-        if text[i:].startswith(open):
-            d += 1
-            i += len(open)
+    return "".join(ans)
+
+# Kappaleen teksti jaetaan välilyönneistä sanoiksi. Jokainen sana alkaa edellisen sanan lopussa
+# auki jääneillä koodeilla, jotta sanat voidaan muotoilla toisistaan riippumatta.
+PARAGRAPH_TOKEN_RE = re.compile(r"\\(.?)|( )|(" + "|".join(re.escape(code) for code in itertools.chain(*MARKUP_CODE_LIST)) + r")|[^\\ *}~^_%$\[\]]+|.", re.S)
+
+def prepareText(text: str) -> str:
+    ans: List[str] = []
+    depth = [0] * len(MARKUP_CODE_LIST)
+    for match in PARAGRAPH_TOKEN_RE.finditer(text):
+        escaped, space, code = match.groups()
+        if escaped is not None:
+            if escaped == "n":
+                ans.append("\n")
+            
+            elif escaped == " ":
+                ans.append("\\ ")
+                ans.extend(_carryBalance(depth))
+            
+            else:
+                ans.append(match.group())
+        
+        elif space:
+            ans.append(" ")
+            ans.extend(_carryBalance(depth))
         
-        elif text[i:].startswith(close):
-            d -= 1
-            i += len(close)
+        elif code:
+            pair, opening = MARKUP_CODE_PAIRS[code]
+            depth[pair] += 1 if opening else -1
+            ans.append(code)
         
         else:
-            i += 1
+            ans.append(match.group())
+    
+    return "".join(ans)
+
+def _carryBalance(depth: List[int]) -> List[str]:
+    # Sulkevat koodit eivät siirry seuraavaan sanaan, joten negatiivinen saldo nollataan
+    for pair, d in enumerate(depth):
+        depth[pair] = max(d, 0)
     
-    return d*open
+    return [MARKUP_CODE_LIST[pair][0] * d for pair, d in enumerate(depth) if d]
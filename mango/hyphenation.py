@@ -0,0 +1,337 @@
+import hashlib
+import json
+import marshal
+import os
+import re
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+try:
+    from voikko import libvoikko
+except ImportError:
+    libvoikko = None
+
+from .document import Chapter, DocumentObj, Paragraph, Subenvironment, Table
+from .params import Parameters
+
+# Näin monta uutta sanaa tavutetaan rinnakkain, pienemmät erät samassa prosessissa
+PARALLEL_THRESHOLD = 2000
+BATCH_SIZE = 500
+
+# TeX:n oletukset \lefthyphenmin ja \righthyphenmin
+LEFT_HYPHEN_MIN = 2
+RIGHT_HYPHEN_MIN = 3
+
+TRIE_VERSION = 1
+
+class HyphenatorSpec(NamedTuple):
+    backend: str
+    language: str
+    patterns: str
+
+    @staticmethod
+    def fromParams(params: Parameters) -> "HyphenatorSpec":
+        return HyphenatorSpec(params.hyphenator, params.hyphenation_language, params.hyphenation_patterns)
+
+class Hyphenator(ABC):
+    # Tavutusvälimuisti tunnistetaan avaimesta, joten sen on muututtava, kun tavutus muuttuu
+    key: str
+
+    @abstractmethod
+    def hyphenate(self, word: str) -> str:
+        ...
+
+class VoikkoHyphenator(Hyphenator):
+    def __init__(self, language: str):
+        self.voikko = libvoikko.Voikko(language)
+        dicts = [d for d in libvoikko.Voikko.listDicts() if d.language == language]
+        dictionary = f"{dicts[0].variant}-{dicts[0].description}" if dicts else "default"
+        self.key = f"voikko-{language}-{libvoikko.Voikko.getVersion()}-{dictionary}"
+
+    def hyphenate(self, word: str) -> str:
+        return self.voikko.hyphenate(word)
+
+class PatternTrie(NamedTuple):
+    # Siirtymät avaimella solmu * TRIE_RADIX + merkkikoodi, jotta trie on yksi litteä sanakirja
+    transitions: Dict[int, int]
+    points: Dict[int, Tuple[int, ...]]
+    exceptions: Dict[str, Tuple[int, ...]]
+
+TRIE_RADIX = 0x110000
+
+def parsePatterns(text: str) -> Tuple[List[str], List[str]]:
+    text = re.sub(r"%.*", "", text)
+    patterns = []
+    exceptions = []
+    if "\\patterns" in text or "\\hyphenation" in text:
+        for command, body in re.findall(r"\\(patterns|hyphenation)\s*\{([^}]*)\}", text):
+            (patterns if command == "patterns" else exceptions).extend(body.split())
+
+    else:
+        patterns = text.split()
+
+    return patterns, exceptions
+
+def compilePatterns(patterns: List[str], exceptions: List[str]) -> PatternTrie:
+    transitions: Dict[int, int] = {}
+    points: Dict[int, Tuple[int, ...]] = {}
+    num_nodes = 1
+    for pattern in patterns:
+        letters = re.sub(r"[0-9]", "", pattern).lower()
+        values = [0] * (len(letters) + 1)
+        i = 0
+        for char in pattern:
+            if char.isdigit():
+                values[i] = int(char)
+
+            else:
+                i += 1
+
+        node = 0
+        for char in letters:
+            key = node * TRIE_RADIX + ord(char)
+            if key not in transitions:
+                transitions[key] = num_nodes
+                num_nodes += 1
+
+            node = transitions[key]
+
+        points[node] = tuple(values)
+
+    compiled_exceptions = {}
+    for exception in exceptions:
+        word = exception.replace("-", "").lower()
+        breaks = []
+        i = 0
+        for char in exception:
+            if char == "-":
+                breaks.append(i)
+
+            else:
+                i += 1
+
+        compiled_exceptions[word] = tuple(breaks)
+
+    return PatternTrie(transitions, points, compiled_exceptions)
+
+class PatternHyphenator(Hyphenator):
+    def __init__(self, path: str, cache_dir: Optional[str] = None):
+        with open(path, "rb") as f:
+            data = f.read()
+
+        digest = hashlib.sha1(data).hexdigest()[:16]
+        self.key = f"patterns-{os.path.basename(path)}-{digest}-{LEFT_HYPHEN_MIN}-{RIGHT_HYPHEN_MIN}"
+        trie_path = os.path.join(cache_dir, f"patterns-{digest}.trie") if cache_dir else None
+        trie = None
+        if trie_path and os.path.exists(trie_path):
+            with open(trie_path, "rb") as f:
+                version, *fields = marshal.load(f)
+
+            if version == TRIE_VERSION:
+                trie = PatternTrie(*fields)
+
+        if trie is None:
+            trie = compilePatterns(*parsePatterns(data.decode("utf-8")))
+            if trie_path:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(trie_path + ".tmp", "wb") as f:
+                    marshal.dump((TRIE_VERSION, *trie), f)
+
+                os.replace(trie_path + ".tmp", trie_path)
+
+        self.trie = trie
+
+    def breaks(self, letters: str) -> List[int]:
+        if letters in self.trie.exceptions:
+            return list(self.trie.exceptions[letters])
+
+        transitions = self.trie.transitions
+        points = self.trie.points
+        word = "." + letters + "."
+        values = [0] * (len(word) + 1)
+        for i in range(len(word)):
+            node = 0
+            for j in range(i, len(word)):
+                node = transitions.get(node * TRIE_RADIX + ord(word[j]))
+                if node is None:
+                    break
+
+                pattern_values = points.get(node)
+                if pattern_values:
+                    for k, value in enumerate(pattern_values):
+                        if value > values[i + k]:
+                            values[i + k] = value
+
+        # values[k+1] on kirjaimen k edessä olevan kohdan arvo (sanan alussa on piste)
+        return [k for k in range(LEFT_HYPHEN_MIN, len(letters) - RIGHT_HYPHEN_MIN + 1) if values[k + 1] % 2]
+
+    def hyphenate(self, word: str) -> str:
+        # Merkintäkoodit ja välimerkit ohitetaan, ja tavuviivat lisätään kirjainten väliin
+        positions = []
+        escaped = False
+        for i, char in enumerate(word):
+            if escaped:
+                escaped = False
+
+            elif char == "\\":
+                escaped = True
+
+            elif char.isalpha():
+                positions.append(i)
+
+        letters = "".join(word[i] for i in positions).lower()
+        ans = word
+        for k in reversed(self.breaks(letters)):
+            i = positions[k]
+            ans = ans[:i] + "-" + ans[i:]
+
+        return ans
+
+def createHyphenator(spec: HyphenatorSpec, cache_dir: Optional[str] = None) -> Optional[Hyphenator]:
+    if spec.backend == "voikko":
+        if libvoikko is None:
+            return None
+
+        try:
+            return VoikkoHyphenator(spec.language)
+        except:
+            return None
+
+    elif spec.backend == "patterns":
+        if not spec.patterns:
+            raise RuntimeError("The patterns hyphenator needs a hyphenation_patterns file")
+
+        return PatternHyphenator(spec.patterns, cache_dir)
+
+    elif spec.backend == "none":
+        return None
+
+    else:
+        raise RuntimeError("Unknown hyphenator " + repr(spec.backend))
+
+worker_hyphenator: Optional[Hyphenator] = None
+
+def _initWorker(spec: HyphenatorSpec, cache_dir: Optional[str]):
+    global worker_hyphenator
+    worker_hyphenator = createHyphenator(spec, cache_dir)
+
+def _hyphenateBatch(words: List[str]) -> List[str]:
+    return [worker_hyphenator.hyphenate(word) for word in words]
+
+def collectWords(paragraphs: Iterable[DocumentObj], words: Set[str]):
+    for pg in paragraphs:
+        if isinstance(pg, Paragraph):
+            # Otsikoita ei tavuteta
+            if pg.type in {"text", "ctext"}:
+                for line in pg.text.split("\n"):
+                    words.update(word for word in line.split(" ") if word and "-" not in word)
+
+        elif isinstance(pg, Table):
+            for row in pg.rows:
+                collectWords(row, words)
+
+        elif isinstance(pg, Subenvironment):
+            collectWords(pg.paragraphs, words)
+
+class HyphenationCache:
+    def __init__(self, spec: HyphenatorSpec, hyphenator: Hyphenator, cache_dir: Optional[str]):
+        self.spec = spec
+        self.hyphenator = hyphenator
+        self.cache_dir = cache_dir
+        self.words: Dict[str, str] = {}
+        self.path = None
+        self.dirty = False
+        # Tavuttajan todelliset kutsut; välimuistista löytyneitä sanoja ei lasketa
+        self.calls = 0
+        self.executor: Optional[ProcessPoolExecutor] = None
+        if cache_dir:
+            self.path = os.path.join(cache_dir, re.sub(r"[^\w.-]+", "_", hyphenator.key) + ".json")
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r") as f:
+                        self.words = json.load(f)
+
+                except (OSError, ValueError) as e:
+                    print(f"Tavutusvälimuistia ei voitu lukea: {e}")
+
+    def hyphenate(self, word: str) -> str:
+        ans = self.words.get(word)
+        if ans is None:
+            self.calls += 1
+            ans = self.hyphenator.hyphenate(word)
+            self.words[word] = ans
+            self.dirty = True
+
+        return ans
+
+    def prepare(self, chapters: Iterable[Chapter]):
+        words: Set[str] = set()
+        for chapter in chapters:
+            collectWords(chapter, words)
+
+        new_words = [word for word in words if word not in self.words]
+        if not new_words:
+            return
+
+        print(f"Tavutetaan {len(new_words)} uutta sanaa...")
+        self.calls += len(new_words)
+        if len(new_words) >= PARALLEL_THRESHOLD and (os.cpu_count() or 1) > 1:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(initializer=_initWorker, initargs=(self.spec, self.cache_dir))
+
+            batches = [new_words[i:i+BATCH_SIZE] for i in range(0, len(new_words), BATCH_SIZE)]
+            for batch, hyphenated in zip(batches, self.executor.map(_hyphenateBatch, batches)):
+                self.words.update(zip(batch, hyphenated))
+
+        else:
+            self.words.update((word, self.hyphenator.hyphenate(word)) for word in new_words)
+
+        self.dirty = True
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+        if self.dirty and self.path:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.words, f, ensure_ascii=False)
+
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+class Hyphenation:
+    def __init__(self, cache_dir: Optional[str]):
+        self.cache_dir = cache_dir
+        self.caches: Dict[HyphenatorSpec, Optional[HyphenationCache]] = {}
+
+    def get(self, params: Parameters) -> Optional[HyphenationCache]:
+        spec = HyphenatorSpec.fromParams(params)
+        if spec not in self.caches:
+            hyphenator = createHyphenator(spec, self.cache_dir)
+            if hyphenator is None:
+                if spec.backend != "none":
+                    print(f"Tavuttajaa {spec.backend} ei voitu ladata, tavutus ei ole käytössä")
+
+                self.caches[spec] = None
+
+            else:
+                self.caches[spec] = HyphenationCache(spec, hyphenator, self.cache_dir)
+
+        return self.caches[spec]
+
+    def calls(self) -> int:
+        return sum(cache.calls for cache in self.caches.values() if cache)
+
+    def prepare(self, params: Parameters, chapters: Iterable[Chapter]):
+        cache = self.get(params)
+        if cache:
+            cache.prepare(chapters)
+
+    def close(self):
+        for cache in self.caches.values():
+            if cache:
+                cache.close()
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import pickle
+import types
+from typing import Any, Iterable, List, Optional, Tuple
+
+from . import __version__
+from .document import DocumentObj
+
+# Kasvatetaan, kun välimuistiin tallennettavien rivien muoto muuttuu
+LAYOUT_CACHE_VERSION = 3
+
+class Uncacheable(Exception):
+    pass
+
+def describe(obj: Any, seen: Optional[set] = None) -> Any:
+    # Muuttaa dokumentin olion vertailukelpoiseksi rakenteeksi. Eval-olioiden funktiot kuvataan
+    # koodinsa ja sulkeumiensa sisällön perusteella.
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        return obj
+
+    elif isinstance(obj, (list, tuple)):
+        return (type(obj).__name__, tuple(describe(item, seen) for item in obj))
+
+    elif isinstance(obj, dict):
+        return ("dict", tuple((describe(k, seen), describe(v, seen)) for k, v in obj.items()))
+
+    elif isinstance(obj, types.CodeType):
+        return ("code", obj.co_code, obj.co_names, describe(obj.co_consts, seen))
+
+    elif isinstance(obj, types.FunctionType):
+        seen = seen or set()
+        if id(obj) in seen:
+            return ("recursive", obj.__qualname__)
+
+        seen = seen | {id(obj)}
+        closure = tuple(describe(cell.cell_contents, seen) for cell in obj.__closure__ or ())
+        return ("function", obj.__qualname__, describe(obj.__code__, seen), closure, describe(obj.__defaults__, seen))
+
+    raise Uncacheable(f"Cannot describe {type(obj).__name__} for the layout cache")
+
+def chapterKey(paragraphs: List[DocumentObj], state: bytes, *settings: Any) -> Optional[str]:
+    try:
+        content = pickle.dumps((LAYOUT_CACHE_VERSION, __version__, describe(paragraphs), settings))
+    except (Uncacheable, ValueError):
+        return None
+
+    return hashlib.sha256(content + state).hexdigest()
+
+class LayoutCache:
+    def __init__(self, cache_dir: str, max_size: int):
+        self.path = os.path.join(cache_dir, "layout")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[List[Tuple[list, Any, bool]]]:
+        path = os.path.join(self.path, key + ".pickle")
+        try:
+            with open(path, "rb") as f:
+                pages = pickle.load(f)
+
+            # Muokkausaika kertoo, milloin tiedostoa on viimeksi käytetty
+            os.utime(path)
+
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return pages
+
+    def put(self, key: str, pages: Iterable[Tuple[list, Any, bool]]):
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, key + ".pickle")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(list(pages), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        except (pickle.PicklingError, TypeError):
+            os.remove(tmp_path)
+            return
+
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+            total -= size
@@ -0,0 +1,60 @@
+import functools
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+import pangocffi as pango
+
+
+FontKey = Tuple[Optional[str], int]
+MetricsKey = Tuple[Optional[str], int, str]
+
+class Metrics:
+    __slots__ = ("width", "height", "layout")
+
+    def __init__(self, width: float, height: float, layout: Optional[pango.Layout] = None):
+        self.width = width
+        self.height = height
+        self.layout = layout
+
+class MetricsCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: "OrderedDict[Hashable, Metrics]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: MetricsKey) -> Optional[Metrics]:
+        entry = self.entries.get(key)
+        self.record(key, entry)
+        return entry
+    
+    def peek(self, key: MetricsKey) -> Optional[Metrics]:
+        # Ennakkohaku ei päivitä laskureita eikä käyttöjärjestystä, vaan tulos kirjataan record-kutsulla
+        return self.entries.get(key)
+    
+    def record(self, key: MetricsKey, entry: Optional[Metrics]):
+        if entry is None:
+            self.misses += 1
+            return
+        
+        # Ennakkohaun jälkeen lisätyt mitat ovat voineet jo poistaa rivin välimuistista
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        
+        self.hits += 1
+    
+    def put(self, key: MetricsKey, entry: Metrics):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+# Samaa fonttia käytetään kaikkialla, joten palautettuja olioita ei saa muokata
+@functools.lru_cache(maxsize=256)
+def fontFromKey(key: FontKey) -> pango.FontDescription:
+    font = pango.FontDescription()
+    if key[0] is not None:
+        font.set_family(key[0])
+    
+    font.set_size(key[1])
+    return font
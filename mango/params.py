@@ -1,8 +1,25 @@
 from argparse import Namespace
-from typing import Dict, Literal
+from typing import Dict, Literal, NamedTuple, Optional
 
 import pangocffi as pango
 
+from .metrics import FontKey
+
+class Style(NamedTuple):
+    # Kaikki kappaleen latomiseen vaikuttavat asetukset. Tyylit internoidaan, joten samat asetukset
+    # jakavat saman olion ja fontin avain on laskettu valmiiksi.
+    font: FontKey
+    font_size: float
+    line_height: float
+    text_align: str
+    line_width: float
+    min_word_gap: float
+    indent: float
+
+STYLES: Dict[Style, Style] = {}
+
+def internStyle(style: Style) -> Style:
+    return STYLES.setdefault(style, style)
 
 class Parameters:
     width: float
@@ -17,9 +34,14 @@ class Parameters:
     indent: float
     text_align: Literal["justify", "center"]
     smart_page_breaks = True
+    page_break_lookahead: float
+    shape_paragraphs: bool
+    hyphenator: Literal["voikko", "patterns", "none"]
+    hyphenation_language: str
+    hyphenation_patterns: str
 
     font: str
-    fonts: Dict[str, pango.FontDescription]
+    fonts: Dict[str, str]
 
     def __init__(self, args: Namespace):
         self.width = float(args.width)
@@ -35,21 +57,34 @@ class Parameters:
         self.quote_indent = float(50)
         self.text_align = "justify"
         self.font_size = float(10)
+        self.page_break_lookahead = float(args.page_break_lookahead)
+        self.shape_paragraphs = args.shape_paragraphs
+        self.hyphenator = args.hyphenator
+        self.hyphenation_language = args.hyphenation_language
+        self.hyphenation_patterns = args.hyphenation_patterns
 
         self.font = "rm"
         self.fonts = {}
-        self.fonts["rm"] = pango.FontDescription()
-        self.fonts["rm"].set_family(args.font)
-        self.fonts["rm"].set_size(pango.units_from_double(10))
+        self.fonts["rm"] = args.font
 
         print(f"Paperin koko {self.width}x{self.height}")
         print(f"Piirtoalueen koko {self.line_width}x{self.page_height}")
     
+    def style(self, font_size: Optional[float] = None, line_height: Optional[float] = None, text_align: Optional[str] = None) -> Style:
+        font_size = self.font_size if font_size is None else font_size
+        return internStyle(Style(
+            (self.fonts[self.font], pango.units_from_double(font_size)),
+            font_size,
+            self.line_height if line_height is None else line_height,
+            self.text_align if text_align is None else text_align,
+            self.line_width,
+            self.min_word_gap,
+            self.indent,
+        ))
+    
     def resetLayout(self):
         self.indent = 0
     
     def addFont(self, varname, fontname):
         print(f"Lisätään fontti {varname} = {repr(fontname)}")
-        self.fonts[varname] = pango.FontDescription()
-        self.fonts[varname].set_family(fontname)
-        self.fonts[varname].set_size(pango.units_from_double(10))
\ No newline at end of file
+        self.fonts[varname] = fontname
\ No newline at end of file
@@ -1,35 +1,54 @@
+import bisect
 import copy
 import itertools
+import multiprocessing
+import os
+import pickle
 import re
+import tempfile
+import time
 from argparse import Namespace
-from collections import defaultdict
+from array import array
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from math import inf
-from typing import Callable, List, Optional, Tuple
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 import cairocffi as cairo
 import numpy as np
 import pangocairocffi as pangocairo
 import pangocffi as pango
-from tqdm.cli import tqdm
-from voikko import libvoikko
 
+try:
+    import pypdf
+    from pypdf.generic import Fit
+except ImportError:
+    pypdf = None
+
+from .displaylist import DisplayList, Outline, Rule, TabRun, TextRun
 from .document import (Chapter, DocumentObj, Eval, HLine, Paragraph, Subenvironment,
                        Table, VSpace, fixMarkup, stripMarkup)
-from .params import Parameters
-
-try:
-    voikko = libvoikko.Voikko("fi")
-except:
-    voikko = None
+from .hyphenation import Hyphenation
+from .layoutcache import LayoutCache, chapterKey
+from .metrics import FontKey, Metrics, MetricsCache, fontFromKey
+from .params import Parameters, Style
+from .stats import ChapterStats, Stats
 
 debug = False
 
-def irange(a, b, s=1) -> range:
-    return range(a, b+1 if s > 0 else b-1, s)
+# Tavutuskohdan arvioitu leveys saa poiketa mitatusta enintään näin paljon (fontin koon osina, 10 pisteen
+# fontilla 2 pistettä)
+HYPHENATION_TOLERANCE = 0.2
+
+# Rinnakkaisessa ladonnassa työprosessille annetaan kerralla näin monta kappaletta,
+# ja jonossa on enintään LAYOUT_WINDOW erää työprosessia kohden
+LAYOUT_BATCH = 16
+LAYOUT_WINDOW = 4
 
 FixXY = Callable[[float, float], Tuple[float, float]]
 
 class Line:
+    __slots__ = ("height", "width", "indent", "no_page_break", "outline", "is_content_line")
     outline: Optional[Tuple[int, str]]
     def __init__(self, width: float, height: float, no_page_break=False):
         self.height = height
@@ -47,8 +66,12 @@ class Line:
             context.set_source_rgb(0.5, 0.5, 0.5)
             context.rectangle(*fxy(self.indent+x, y), *fxy(self.width, self.height))
             context.stroke()
+    
+    def record(self, dl: DisplayList, x: float, y: float, fxy: FixXY):
+        pass
 
 class ParagraphGap(Line):
+    __slots__ = ()
 
     def draw(self, context: cairo.Context, x: float, y: float, fxy: FixXY):
         super().draw(context, x, y, fxy)
@@ -58,6 +81,8 @@ class ParagraphGap(Line):
             context.fill()
 
 class HorizontalLine(Line):
+    __slots__ = ()
+
     def __init__(self, width: float, height: float, no_page_break=False):
         super().__init__(width, height, no_page_break)
         self.is_content_line = False
@@ -73,28 +98,131 @@ class HorizontalLine(Line):
         context.move_to(*fxy(x, y+self.height/2))
         context.line_to(*fxy(x + self.width, y+self.height/2))
         context.stroke()
+    
+    def record(self, dl: DisplayList, x: float, y: float, fxy: FixXY):
+        dl.ops.append(Rule(*fxy(x, y+self.height/2), *fxy(x + self.width, y+self.height/2), 0.8))
 
-def stripGaps(lines: List[Line]) -> List[Line]:
-    i = 0
-    while i < len(lines) and isinstance(lines[i], ParagraphGap):
-        i += 1
+class LineMetrics:
+    # Sivunvaihdot lasketaan pelkistä rivien korkeuksista ja lipuista, jotka kerätään tiiviisiin taulukoihin
+    __slots__ = ("heights", "no_page_breaks", "gaps")
+
+    def __init__(self, heights: Optional[array] = None, no_page_breaks: Optional[array] = None, gaps: Optional[array] = None):
+        self.heights = array("d") if heights is None else heights
+        self.no_page_breaks = array("b") if no_page_breaks is None else no_page_breaks
+        self.gaps = array("b") if gaps is None else gaps
+
+    @staticmethod
+    def fromLines(lines: Iterable[Line]) -> "LineMetrics":
+        ans = LineMetrics()
+        for line in lines:
+            ans.append(line)
+        
+        return ans
     
-    j = len(lines)
-    while j > 0 and isinstance(lines[j - 1], ParagraphGap):
-        j -= 1
+    def append(self, line: Line):
+        self.heights.append(line.height)
+        self.no_page_breaks.append(1 if line.no_page_break else 0)
+        self.gaps.append(1 if isinstance(line, ParagraphGap) else 0)
+    
+    def __len__(self) -> int:
+        return len(self.heights)
+    
+    def __getitem__(self, index: slice) -> "LineMetrics":
+        return LineMetrics(self.heights[index], self.no_page_breaks[index], self.gaps[index])
+    
+    def contentRange(self) -> Tuple[int, int, int]:
+        # Palauttaa rivit i..j-1, jotka jäävät alun ja lopun kappalevälien poistamisen jälkeen,
+        # sekä niiden joukossa olevien välien määrän
+        content = np.flatnonzero(np.frombuffer(self.gaps, dtype=np.int8) == 0)
+        if len(content) == 0:
+            return len(self), len(self), 0
+        
+        i, j = int(content[0]), int(content[-1]) + 1
+        return i, j, j - i - len(content)
     
-    return lines[i:j]
+    def contentHeight(self) -> float:
+        i, j, _ = self.contentRange()
+        return float(np.sum(np.frombuffer(self.heights, dtype=np.float64)[i:j]))
 
-def splitGaps(lines: List[Line]) -> List[List[Line]]:
-    pgs = [[]]
-    for line in lines:
-        pgs[-1].append(line)
-        if isinstance(line, ParagraphGap):
-            pgs.append([])
+def optimalPageBreaks(metrics: LineMetrics, page_height: float) -> List[int]:
+    n = len(metrics)
+    if n == 0:
+        return []
+
+    # heights[k] on rivien [:k] korkeuksien summa, first[i] ensimmäinen ei-väli rivi indeksistä i
+    # alkaen ja last[j] viimeinen ei-väli rivi indeksiin j asti. Sivun i..j korkeus ilman reunojen
+    # välejä on siis heights[last[j]+1] - heights[first[i]].
+    heights = np.concatenate(([0.0], np.cumsum(np.array(metrics.heights, dtype=np.float64))))
+    gaps = np.array(metrics.gaps, dtype=bool)
+    indices = np.arange(n)
+    last = np.maximum.accumulate(np.where(gaps, -1, indices))
+    first = np.append(np.minimum.accumulate(np.where(gaps, n, indices)[::-1])[::-1], n)
+    ends = heights[last + 1]
+    no_page_breaks = metrics.no_page_breaks
+    # Negatiivinen pystyväli voi lyhentää sivua, jolloin kaikki loppukohdat on käytävä läpi
+    monotonic = bool(np.all(heights[1:] >= heights[:-1]))
+
+    def pageHeight(a: int, j: int) -> float:
+        return float(ends[j] - heights[a]) if a <= last[j] else 0.0
+
+    def fits(a: int, j: int) -> bool:
+        return (page_height - pageHeight(a, j)) ** 3 >= 0
+
+    # scores[i] on paras pisteytys riveistä i alkaen ja bps[i] sitä vastaava seuraava sivunvaihto
+    scores = np.full(n + 1, inf)
+    bps: List[Optional[int]] = [None] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        a = int(first[i])
+        ans = (page_height - pageHeight(a, n - 1)) ** 3
+        if ans < 0:
+            min_score = inf
+        
+        elif no_page_breaks[i]:
+            min_score = ans + 1e50
+        
+        else:
+            min_score = 0
+        
+        if monotonic:
+            # Sivut vain pitenevät, joten sivulle mahtuvat loppukohdat j ovat välillä i..k-1
+            k = min(int(np.searchsorted(ends, heights[a] + page_height, side="right")), n - 1)
+            while k > i and not fits(a, k - 1):
+                k -= 1
+            
+            while k < n - 1 and fits(a, k):
+                k += 1
+        
+        else:
+            k = n - 1
+
+        min_x = None
+        if k > i:
+            page_heights = np.where(a <= last[i:k], ends[i:k] - heights[a], 0.0)
+            page_badness = (page_height - page_heights) ** 3
+            page_badness[page_badness < 0] = inf
+            if no_page_breaks[i]:
+                page_badness += 1e50
+            
+            page_scores = scores[i+1:k+1] + page_badness
+            m = int(np.argmin(page_scores))
+            if page_scores[m] < min_score:
+                min_score = float(page_scores[m])
+                min_x = i + 1 + m
+        
+        scores[i] = min_score
+        bps[i] = min_x
+    
+    ans = []
+    i = 0
+    while bps[i] is not None:
+        i = bps[i]
+        ans.append(i)
     
-    return pgs
+    return ans
 
 class TextLine(Line):
+    __slots__ = ("surf",)
+
     def __init__(self, surf: cairo.Surface, width: float, height: float, indent:float=0.0, no_page_break=False):
         self.surf = surf
         self.width = width
@@ -109,8 +237,57 @@ class TextLine(Line):
         context.set_source_surface(self.surf, *fxy(x+self.indent, y))
         context.paint()
         self.surf.finish()
+    
+    def record(self, dl: DisplayList, x: float, y: float, fxy: FixXY):
+        raise RuntimeError("Recorded text lines cannot be written to a display list")
+
+class WordLine(Line):
+    # Rivi tallentaa vain sanojen paikat, Pango-merkinnät ja fontin, ja sanat piirretään suoraan sivulle
+    __slots__ = ("words", "font", "tabs")
+
+    def __init__(self, words: List[Tuple[float, str]], font: FontKey, width: float, height: float, tabs: bool, indent:float=0.0, no_page_break=False):
+        self.words = words
+        self.font = font
+        self.tabs = tabs
+        self.width = width
+        self.height = height
+        self.indent = indent
+        self.no_page_break = no_page_break
+        self.outline = None
+        self.is_content_line = True
+    
+    def draw(self, context: cairo.Context, x: float, y: float, fxy: FixXY):
+        super().draw(context, x, y, fxy)
+        font = fontFromKey(self.font)
+        context.save()
+        pushTextGroup(context)
+        context.translate(*fxy(x+self.indent, y))
+        if self.tabs:
+            pangocairo.show_layout(context, createTabLayout(context, font, [markup for _, markup in self.words], [wx for wx, _ in self.words]))
+        
+        else:
+            for wx, markup in self.words:
+                context.translate(*fxy(wx, 0))
+                pangocairo.show_layout(context, createLayout(context, font, markup))
+                context.translate(*fxy(-wx, 0))
+        
+        popTextGroup(context)
+        context.restore()
+    
+    def record(self, dl: DisplayList, x: float, y: float, fxy: FixXY):
+        font = dl.fontIndex(self.font)
+        ox, oy = fxy(x+self.indent, y)
+        if self.tabs:
+            dl.ops.append(TabRun(font, ox, oy, self.words))
+        
+        else:
+            for wx, markup in self.words:
+                dx, dy = fxy(wx, 0)
+                dl.ops.append(TextRun(font, ox+dx, oy+dy, markup))
 
 class ColumnLine(Line):
+    __slots__ = ("columns", "column_gap")
+
     def __init__(self, columns: List[Line], pg_gap: float, indent:float=0.0):
         self.columns = columns
         self.column_gap = pg_gap
@@ -128,6 +305,45 @@ class ColumnLine(Line):
             column.draw(context, x, y, fxy)
             x += column.width
             x += self.column_gap
+    
+    def record(self, dl: DisplayList, x: float, y: float, fxy: FixXY):
+        x += self.indent
+        for column in self.columns:
+            column.record(dl, x, y, fxy)
+            x += column.width
+            x += self.column_gap
+
+def solveColumnWidths(mins: np.ndarray, maxs: np.ndarray, available: float) -> np.ndarray:
+    # Kapeimmat sarakkeet saavat luonnollisen leveytensä, ja muut jakavat jäljelle jäävän tilan
+    # tasan. Jos tasajako jää jonkin sarakkeen pisintä sanaa kapeammaksi, sarake saa sanan leveyden
+    # ja muut sarakkeet jakavat loput. Sanan leveys varataan kuitenkin enintään tasajaon verran,
+    # ettei taulukko ylitä marginaalia, ja kapeammissa sarakkeissa pitkät sanat tavutetaan.
+    mins = np.minimum(mins, available / len(mins))
+    maxs = np.maximum(maxs, mins)
+    widths = maxs.copy()
+    free = np.ones(len(maxs), dtype=bool)
+    while free.any():
+        columns = np.flatnonzero(free)
+        space = available - widths[~free].sum()
+        ordered = np.sort(maxs[columns])
+        # shares[k] on tasajako, jos k kapeinta saraketta saa luonnollisen leveytensä
+        shares = (space - np.concatenate(([0.0], np.cumsum(ordered)[:-1]))) / (len(columns) - np.arange(len(columns)))
+        wide = ordered > shares
+        share = shares[np.argmax(wide)] if wide.any() else inf
+        widths[columns] = np.minimum(maxs[columns], share)
+        too_narrow = free & (widths < mins)
+        if not too_narrow.any():
+            break
+        
+        widths[too_narrow] = mins[too_narrow]
+        free &= ~too_narrow
+    
+    return widths
+
+class Word(NamedTuple):
+    text: str
+    width: float
+    height: float
 
 TITLES = {
     "ctitle": (0, 20, 26, "center"),
@@ -142,25 +358,179 @@ TITLES = {
     "text": (-1, 10, 16, "justify"),
 }
 
+def containsEval(pg: DocumentObj) -> bool:
+    if isinstance(pg, Eval):
+        return True
+    
+    elif isinstance(pg, Table):
+        return any(containsEval(item) for row in pg.rows for item in row)
+    
+    elif isinstance(pg, Subenvironment):
+        return any(containsEval(item) for item in pg.paragraphs)
+    
+    return False
+
+def applyEvals(params: Parameters, paragraphs: List[DocumentObj]):
+    # Käy läpi parametrimuutokset samassa järjestyksessä ja samoissa pinokehyksissä kuin latoja
+    for pg in paragraphs:
+        if isinstance(pg, Eval):
+            pg.func(params)
+        
+        elif isinstance(pg, Table):
+            frame = copy.copy(params)
+            for i in range(max(len(row) for row in pg.rows)):
+                for row in pg.rows:
+                    if i < len(row):
+                        applyEvals(frame, [row[i]])
+        
+        elif isinstance(pg, Subenvironment):
+            applyEvals(copy.copy(params), pg.paragraphs)
+
+def mergeChapters(paths: List[str], results: List[Tuple[int, List[Outline]]], outfile: str, page_height: float):
+    # Luvut liitetään peräkkäin, ja sisällysluettelo rakennetaan uudelleen lopullisilla sivunumeroilla
+    writer = pypdf.PdfWriter()
+    parents: Dict[int, Any] = {}
+    offset = 0
+    for path, (num_pages, outlines) in zip(paths, results):
+        writer.append(path, import_outline=False)
+        for outline in outlines:
+            parents[outline.level] = writer.add_outline_item(outline.title, offset + outline.page - 1, parent=parents.get(outline.level - 1), fit=Fit.xyz(outline.x, page_height - outline.y))
+        
+        offset += num_pages
+    
+    with open(outfile, "wb") as f:
+        writer.write(f)
+
+# Työprosessit perivät tämän piirtäjän fork-kutsussa
+layout_worker: Optional["draw"] = None
+chapter_worker: Optional["draw"] = None
+chapter_jobs: List[Chapter] = []
+
+def _drawChapter(i: int, state: bytes, path: str, args: Namespace) -> Tuple[int, List[Outline], Optional[ChapterStats]]:
+    # Jokainen luku alkaa parittomalta sivulta, joten luvun voi piirtää omaksi tiedostokseen sivusta 1 alkaen
+    drawer = chapter_worker
+    drawer.params = pickle.loads(state)
+    drawer.param_stack = []
+    drawer.layout_workers = 0
+    drawer.outlines = []
+    drawer.stats = Stats() if drawer.stats else None
+    drawer.openSurface(path, args.width, args.height)
+    print(f"Piirretään kappale {i+1}...")
+    drawer.drawChapter(chapter_jobs[i])
+    drawer.surf.finish()
+    return drawer.page - 1, drawer.outlines, drawer.stats.chapters[0] if drawer.stats else None
+
+def _layoutBatch(job: bytes) -> List[List[Line]]:
+    params, pgs = pickle.loads(job)
+    ans = []
+    for pg in pgs:
+        layout_worker.params = params
+        layout_worker.param_stack = []
+        ans.append(layout_worker.layoutItem(pg))
+    
+    return ans
+
 class draw:
-    def __init__(self, args: Namespace, chapters: List[Chapter]):
+    def __init__(self, args: Namespace, chapters: Optional[Iterable[Chapter]] = None, stats: Optional[Stats] = None):
         global debug
         debug = args.debug
         
         print("Alustetaan...")
+        self.args = args
+        self.page_direction = args.page_dir
+        self.layout_workers = args.layout_workers
+        # Työprosesseista palautettavien ja välimuistiin tallennettavien rivien on oltava pelkkää dataa
+        self.direct_paint = args.direct_paint or self.layout_workers > 0 or args.layout_cache or args.watch or args.outfile.endswith(".mngd")
+
+        self.stats = stats
+        self.metrics = MetricsCache(args.metrics_cache_size)
+        self.hyphenation = Hyphenation(args.cache_dir)
+        self.style: Optional[Style] = None
+        self.outlines: Optional[List[Outline]] = None
+        self.display_list: Optional[DisplayList] = None
+        self.layout_cache = LayoutCache(args.cache_dir, args.layout_cache_size * 1024 * 1024) if args.layout_cache and args.cache_dir else None
+        # Valvontatilassa edellisen piirron luvut pidetään muistissa
+        self.chapter_cache: Optional[Dict[str, List[Tuple[List[Line], LineMetrics, bool]]]] = {} if args.watch else None
+        self.previous_chapters: Dict[str, List[Tuple[List[Line], LineMetrics, bool]]] = {}
+
+        if chapters is not None:
+            self.render(chapters)
+            self.close()
+    
+    def render(self, chapters: Iterable[Chapter]):
+        args = self.args
         self.params = Parameters(args)
         self.param_stack = []
+        if self.chapter_cache is not None:
+            self.previous_chapters, self.chapter_cache = self.chapter_cache, {}
+        
+        if self.stats:
+            chapters = self.stats.timeParse(chapters)
 
-        self.page_direction = args.page_dir
+        # Valvontatilassa PDF kirjoitetaan ensin väliaikaiseen tiedostoon, jotta katselin ei näe puolivalmista tiedostoa
+        outfile = args.outfile + ".tmp" if args.watch else args.outfile
+        if args.chapter_workers > 0:
+            if args.outfile.endswith(".mngd"):
+                raise RuntimeError("Display lists cannot be written with --chapter_workers")
+            
+            self.drawChaptersInParallel(args, chapters, outfile)
+        
+        else:
+            self.drawChapters(chapters, outfile)
+        
+        if outfile != args.outfile:
+            os.replace(outfile, args.outfile)
+    
+    def drawChapters(self, chapters: Iterable[Chapter], outfile: str):
+        if self.args.outfile.endswith(".mngd"):
+            # Mittaukset tehdään PDF-pinnalla, jonka tuloste hylätään, ja sivut tallennetaan piirtolistaan
+            self.openSurface(None, self.args.width, self.args.height)
+            self.display_list = DisplayList(*self._fixXY(self.args.width, self.args.height))
+            self.outlines = []
+        
+        else:
+            self.openSurface(outfile, self.args.width, self.args.height)
+
+        executor = None
+        if self.layout_workers > 0:
+            # Työprosessit perivät tavutukset, joten koko dokumentti luetaan ja tavutetaan ennen niiden luomista
+            chapters = list(chapters)
+            self.hyphenation.prepare(self.params, chapters)
+            executor = self.createLayoutPool()
+        
+        try:
+            for i, chapter in enumerate(chapters):
+                print(f"Piirretään kappale {i+1}...")
+                self.drawChapter(chapter, executor)
+        
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
 
-        self.surf = cairo.PDFSurface(args.outfile, *self._fixXY(args.width, args.height))
+        self.surf.finish()
+        if self.display_list:
+            self.display_list.outlines = self.outlines
+            with open(outfile, "wb") as f:
+                self.display_list.write(f)
+            
+            self.display_list = None
+            self.outlines = None
+    
+    def close(self):
+        self.hyphenation.close()
+        print(f"Mittausvälimuisti: {self.metrics.hits} osumaa, {self.metrics.misses} ohitusta")
+        if self.layout_cache:
+            print(f"Asetteluvälimuisti: {self.layout_cache.hits} osumaa, {self.layout_cache.misses} ohitusta")
+    
+    def openSurface(self, outfile: Optional[str], width: float, height: float):
+        self.surf = cairo.PDFSurface(outfile, *self._fixXY(width, height))
         self.context = cairo.Context(self.surf)
 
         #font_options = cairo.FontOptions()
         #font_options.set_antialias(cairo.ANTIALIAS_NONE)
         #self.context.set_font_options(font_options)
 
-        self.context.rectangle(0, 0, *self._fixXY(args.width, args.height))
+        self.context.rectangle(0, 0, *self._fixXY(width, height))
         self.context.set_source_rgb(1, 1, 1)
         self.context.fill()
 
@@ -168,228 +538,476 @@ class draw:
         
         self.page = 1
         self.last_title = defaultdict(lambda: 0)
-
-        for i, chapter in enumerate(chapters):
-            print(f"Piirretään kappale {i+1}...")
-            self.drawChapter(chapter)
-
-        self.surf.finish()
     
-    def drawChapter(self, paragraphs: Chapter):
-        print("Piirretään sanoja...")
-        all_lines = self.paragraphsToLines(paragraphs)
-        print(f"Piirretty {len(all_lines)} riviä!")
-
-        print("Lasketaan sivunvaihdot...")
-        bps = self.calculatePageBreaks(all_lines)
-        print(f"Laskettu {len(bps)+1} sivua!")
-
-        print("Piirretään sivuja...")
-        for i, j in zip([0] + bps, bps + [len(all_lines)+1]):
-            lines = stripGaps(all_lines[i:j])
-            pgs = splitGaps(lines)
-            if j == len(all_lines) + 1 or len(pgs) == 1:
-                pg_gap = 0
-            else:
-                pg_gap = (self.params.page_height - sum(l.height for pg in pgs for l in pg)) / (len(pgs) - 1)
+    def drawChaptersInParallel(self, args: Namespace, chapters: Iterable[Chapter], outfile: str):
+        global chapter_worker, chapter_jobs
+        if pypdf is None:
+            raise RuntimeError("Chapter-parallel rendering needs the pypdf package")
+        
+        chapters = list(chapters)
+        # Luvun alussa voimassa olevat parametrit ratkaistaan suorittamalla edellisten lukujen Eval-oliot
+        self.hyphenation.prepare(self.params, chapters)
+        states = []
+        for chapter in chapters:
+            states.append(pickle.dumps(self.params))
+            applyEvals(self.params, chapter)
+        
+        chapter_worker = self
+        chapter_jobs = chapters
+        _, height = self._fixXY(args.width, args.height)
+        with tempfile.TemporaryDirectory(prefix="mango-") as tmp_dir:
+            paths = [os.path.join(tmp_dir, f"chapter-{i+1}.pdf") for i in range(len(chapters))]
+            with ProcessPoolExecutor(args.chapter_workers, mp_context=multiprocessing.get_context("fork")) as executor:
+                results = list(executor.map(_drawChapter, range(len(chapters)), states, paths, itertools.repeat(args)))
+            
+            if self.stats:
+                for _, _, chapter_stats in results:
+                    self.stats.addChapter(chapter_stats)
+            
+            print("Yhdistetään luvut...")
+            mergeChapters(paths, [(num_pages, outlines) for num_pages, outlines, _ in results], outfile, height)
+    
+    def drawChapter(self, paragraphs: Chapter, executor: Optional[ProcessPoolExecutor] = None):
+        if self.stats:
+            self.stats.startChapter(self.counters())
+        
+        start = time.perf_counter()
+        if executor is None:
+            # Työprosessit perivät koko dokumentin tavutukset, muuten tavutetaan luku kerrallaan
+            self.hyphenation.prepare(self.params, [paragraphs])
+        
+        key = self.chapterKey(paragraphs) if self.layout_cache or self.chapter_cache is not None else None
+        cached = self.previous_chapters.get(key) if key else None
+        if key and cached is None and self.layout_cache:
+            cached = self.layout_cache.get(key)
+        
+        if cached is not None:
+            # Luvun parametrimuutokset on silti tehtävä, koska seuraavat luvut riippuvat niistä
+            print("Luku löytyi asetteluvälimuistista")
+            applyEvals(self.params, paragraphs)
+            pages = iter(cached)
+        
+        else:
+            print("Piirretään sanoja...")
+            pages = self.iterPages(self.iterLines(paragraphs, executor))
+        
+        recorded = []
+        num_lines = 0
+        num_pages = 0
+        drawing = 0.0
+        for lines, metrics, last in pages:
+            num_lines += len(lines)
+            num_pages += 1
+            draw_start = time.perf_counter()
+            self.drawPage(lines, metrics, last)
+            drawing += time.perf_counter() - draw_start
+            if key and cached is None:
+                recorded.append((lines, metrics, last))
+        
+        if key and cached is None and self.layout_cache:
+            self.layout_cache.put(key, recorded)
+        
+        if key and self.chapter_cache is not None:
+            self.chapter_cache[key] = recorded if cached is None else cached
+        
+        print(f"Piirretty {num_lines} riviä ja {num_pages} sivua!")
+        
+        if self.page%2 == 0:
+            self.showPage()
+        
+        if self.stats:
+            self.stats.add("drawing", drawing)
+            self.stats.endChapter(self.counters(), time.perf_counter() - start, num_lines, num_pages, cached is not None)
+    
+    def counters(self) -> Dict[str, int]:
+        markup = fixMarkup.cache_info()
+        return {
+            "layouts": layout_count,
+            "fix_markup_calls": markup.hits + markup.misses,
+            "hyphenation_calls": self.hyphenation.calls(),
+            "metrics_hits": self.metrics.hits,
+            "metrics_misses": self.metrics.misses,
+        }
+    
+    def chapterKey(self, paragraphs: Chapter) -> Optional[str]:
+        state = dict(self.params.__dict__)
+        try:
+            state_bytes = pickle.dumps(state)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        
+        hyphenation = self.hyphenation.get(self.params)
+        return chapterKey(paragraphs, state_bytes, self.page_direction, hyphenation.hyphenator.key if hyphenation else None)
+    
+    def createLayoutPool(self) -> ProcessPoolExecutor:
+        global layout_worker
+        layout_worker = self
+        return ProcessPoolExecutor(self.layout_workers, mp_context=multiprocessing.get_context("fork"))
+    
+    def drawPage(self, lines: List[Line], metrics: LineMetrics, last: bool):
+        # Sivun alun ja lopun kappalevälit jätetään pois, ja jäljelle jäävät välit venytetään täyttämään sivu
+        i, j, num_gaps = metrics.contentRange()
+        if last or num_gaps == 0:
+            pg_gap = 0
+        else:
+            pg_gap = (self.params.page_height - metrics.contentHeight()) / num_gaps
 
-            y = self.params.margin
-            for pg in pgs:
-                for line in pg:
-                    if line.outline:
-                        link = self.last_title[line.outline[0] - 1]
-                        self.last_title[line.outline[0]] = self.surf.add_outline(link, line.outline[1], f"page={self.page} pos=[{self.params.margin} {y}]")
+        y = self.params.margin
+        for line, gap in zip(lines[i:j], metrics.gaps[i:j]):
+            if line.outline and self.outlines is not None:
+                self.outlines.append(Outline(line.outline[0], line.outline[1], self.page, self.params.margin, y))
+            
+            elif line.outline:
+                link = self.last_title[line.outline[0] - 1]
+                self.last_title[line.outline[0]] = self.surf.add_outline(link, line.outline[1], f"page={self.page} pos=[{self.params.margin} {y}]")
 
-                    line.draw(self.context, self.params.margin, y, self._fixXY)
-                    y += line.height
-                
+            if self.display_list:
+                line.record(self.display_list, self.params.margin, y, self._fixXY)
+            
+            else:
+                line.draw(self.context, self.params.margin, y, self._fixXY)
+            
+            y += line.height
+            if gap:
                 y += pg_gap
+        
+        self.showPage()
+    
+    def showPage(self):
+        self.surf.show_page()
+        if self.display_list:
+            self.display_list.showPage()
+        
+        self.page += 1
+    
+    def iterPages(self, lines: Iterable[Line]) -> Iterator[Tuple[List[Line], LineMetrics, bool]]:
+        # Sivu lukitaan heti, kun puskurissa on page_break_lookahead sivun verran rivejä (0 = koko luku)
+        buffer: List[Line] = []
+        metrics = LineMetrics()
+        height = 0.0
+        # Jos puskuri ei mahdu yhdelle sivulle eikä kelvollista vaihtoa silti löydy (esim. sivua
+        # korkeampi rivi), uusi yritys tehdään vasta, kun puskuriin on tullut sivun verran lisää rivejä
+        retry_height = 0.0
+        for line in lines:
+            buffer.append(line)
+            metrics.append(line)
+            height += line.height
+            if not self.params.smart_page_breaks:
+                if height > self.params.page_height:
+                    yield buffer[:-1], metrics[:-1], False
+                    buffer = buffer[-1:]
+                    metrics = metrics[-1:]
+                    height = 0.0
             
-            self.surf.show_page()
-            self.page += 1
+            elif self.params.page_break_lookahead > 0 and height > self.params.page_break_lookahead * self.params.page_height and height > retry_height:
+                bps = self.calculatePageBreaks(metrics)
+                if bps:
+                    yield buffer[:bps[0]], metrics[:bps[0]], False
+                    buffer = buffer[bps[0]:]
+                    metrics = metrics[bps[0]:]
+                    height = sum(metrics.heights)
+                    retry_height = 0.0
+                
+                elif metrics.contentHeight() > self.params.page_height:
+                    retry_height = height + self.params.page_height
         
-        if self.page%2 == 0:
-            self.surf.show_page()
-            self.page += 1
+        if not self.params.smart_page_breaks:
+            yield buffer, metrics, True
+            return
+        
+        print("Lasketaan sivunvaihdot...")
+        bps = self.calculatePageBreaks(metrics)
+        for i, j in zip([0] + bps, bps + [len(buffer)+1]):
+            yield buffer[i:j], metrics[i:j], j == len(buffer) + 1
+    
+    def paragraphsToLines(self, paragraphs: List[DocumentObj]) -> List[Line]:
+        return list(self.iterLines(paragraphs))
     
-    def paragraphsToLines(self, paragraphs: List[DocumentObj]):
-        all_lines: List[Line] = []
-        for i, pg in enumerate(paragraphs):
+    def iterLines(self, paragraphs: List[DocumentObj], executor: Optional[ProcessPoolExecutor] = None) -> Iterator[Line]:
+        last_line: Optional[Line] = None
+        for i, (pg, pg_gap, lines) in enumerate(self.iterLayouts(paragraphs, executor)):
             print(i+1, "/", len(paragraphs), end="\r")
 
-            if isinstance(pg, Table):
-                if all_lines and all_lines[-1].is_content_line:
-                    all_lines.append(ParagraphGap(0, self.params.pg_gap, pg.no_page_break))
-            
-                with self._stackFrame():
-                    self._getFont().set_size(pango.units_from_double(self.params.font_size))
-                    indent = self.params.indent
-                    self.params.resetLayout()
-                    num_columns = max(len(row) for row in pg.rows)
-                    max_line_width = self.params.line_width
-                    self.params.line_width = (max_line_width - self.params.column_gap * (num_columns - 1)) / num_columns
-                    rendered_rows: List[List[List[Line]]] = [[] for _ in range(len(pg.rows))]
-                    for i in range(num_columns):
-                        max_width = 0
-                        for j in range(len(pg.rows)):
-                            if i >= len(pg.rows[j]):
-                                pg.rows[j].append(Paragraph.fromText(text=""))
-
-                            rendered_rows[j].append(self.paragraphsToLines([pg.rows[j][i]]))
-                            width = rendered_rows[j][i][0].width if rendered_rows[j][i] else 0
-                            if width > max_width:
-                                max_width = width
-                        
-                        for rrow in rendered_rows:
-                            for line in rrow[i]:
-                                line.width = max_width
-                        
-                        if i != num_columns - 1:
-                            self.params.line_width = (max_line_width - max_width - self.params.column_gap * (num_columns - i - 1)) / (num_columns - i - 1)
-                    
-                    lines = []
-                    for rrow in rendered_rows:
-                        for i in range(max(len(c) for c in rrow)):
-                            column_lines: List[Line] = [c[i] if i < len(c) else Line(c[0].width if c else 0, self.params.line_height) for c in rrow]
-                            lines.append(ColumnLine(column_lines, self.params.column_gap, indent=indent))
-                            lines[-1].no_page_break = pg.no_page_break
+            if isinstance(pg, (Table, Paragraph)) and last_line and last_line.is_content_line:
+                last_line = ParagraphGap(0, pg_gap, pg.no_page_break)
+                yield last_line
+            
+            for line in lines:
+                yield line
+                last_line = line
+    
+    def iterLayouts(self, paragraphs: List[DocumentObj], executor: Optional[ProcessPoolExecutor]) -> Iterator[Tuple[DocumentObj, float, List[Line]]]:
+        # Kappaleen kanssa palautetaan sen kohdalla voimassa ollut kappaleväli
+        if executor is None:
+            for pg in paragraphs:
+                yield pg, self.params.pg_gap, self.layoutItem(pg)
+            
+            return
+        
+        # Parametrit ratkaistaan pääprosessissa järjestyksessä, ja peräkkäiset kappaleet, joiden välissä
+        # ei ole Eval-olioita, ladotaan erissä työprosesseissa samoilla parametreilla
+        pending: Deque[Tuple[List[DocumentObj], float, Union[Future, List[List[Line]]]]] = deque()
+        batch: List[DocumentObj] = []
+        window = LAYOUT_WINDOW * self.layout_workers
+
+        def submit():
+            pending.append((batch[:], self.params.pg_gap, executor.submit(_layoutBatch, pickle.dumps((self.params, batch)))))
+            batch.clear()
+
+        def flush(n: int):
+            while len(pending) > n:
+                pgs, pg_gap, result = pending.popleft()
+                if isinstance(result, Future):
+                    result = result.result()
+                
+                for pg, lines in zip(pgs, result):
+                    yield pg, pg_gap, lines
+
+        for pg in paragraphs:
+            if isinstance(pg, (Paragraph, Table)) and not containsEval(pg):
+                batch.append(pg)
+                if len(batch) >= LAYOUT_BATCH:
+                    submit()
+                
+            else:
+                if batch:
+                    submit()
                 
-            elif isinstance(pg, Paragraph):
-                if all_lines and all_lines[-1].is_content_line:
-                    all_lines.append(ParagraphGap(0, self.params.pg_gap, pg.no_page_break))
+                pending.append(([pg], self.params.pg_gap, [self.layoutItem(pg)]))
+            
+            yield from flush(window)
+        
+        if batch:
+            submit()
+        
+        yield from flush(0)
+    
+    def layoutItem(self, pg: DocumentObj) -> List[Line]:
+        if isinstance(pg, Table):
+            lines = self.layoutTable(pg)
             
-                with self._stackFrame():
+        elif isinstance(pg, Paragraph):
+            level, style = self.paragraphStyle(pg)
+            with self._styleFrame(style):
+                lines = self.textToLines(pg.text, hyphenate=level<0)
+                if lines:
+                    lines[0].no_page_break = pg.no_page_break
+                    if level >= 0:
+                        lines[0].outline = (level, pg.text)
                     
-                    if pg.type != "text":
-                        level, self.params.font_size, self.params.line_height, self.params.text_align = TITLES[pg.type]
+                    if "title" in pg.type:
+                        for line in lines[1:]:
+                            line.no_page_break = True
+        
+        elif isinstance(pg, VSpace):
+            lines = [Line(self.params.line_width, pg.height or self.params.line_height)]
+        
+        elif isinstance(pg, HLine):
+            lines = [HorizontalLine(self.params.line_width, self.params.line_height)]
+            
+        elif isinstance(pg, Eval):
+            pg.func(self.params)
+            lines = []
+        
+        elif isinstance(pg, Subenvironment):
+            with self._stackFrame():
+                lines = self.paragraphsToLines(pg.paragraphs)
+        
+        else:
+            print(f"Tuntematon kappaletyyppi {type(pg)}")
+            lines = []
+        
+        return lines
+
+    def layoutTable(self, pg: Table) -> List[Line]:
+        with self._stackFrame():
+            indent = self.params.indent
+            self.params.resetLayout()
+            num_columns = max(len(row) for row in pg.rows)
+
+            # Solut mitataan ja ladotaan sarakkeittain, jotta solujen Eval-oliot näkyvät samassa
+            # järjestyksessä kummassakin vaiheessa. Mittaus tehdään parametrien kopiolla.
+            with self._stackFrame():
+                mins, maxs = self.measureColumns(pg)
+            
+            widths = solveColumnWidths(mins, maxs, self.params.line_width - self.params.column_gap * (num_columns - 1))
+            rendered_rows: List[List[List[Line]]] = [[] for _ in range(len(pg.rows))]
+            for i in range(num_columns):
+                self.params.line_width = float(widths[i])
+                max_width = 0
+                for j, row in enumerate(pg.rows):
+                    if i < len(row):
+                        rendered = self.paragraphsToLines([row[i]])
                     
                     else:
-                        level = -1
-                    
-                    self._getFont().set_size(pango.units_from_double(self.params.font_size))
-
-                    lines = self.textToLines(pg.text, hyphenate=level<0)
-                    if lines:
-                        lines[0].no_page_break = pg.no_page_break
-                        if level >= 0:
-                            lines[0].outline = (level, pg.text)
-                        
-                        if "title" in pg.type:
-                            for line in lines[1:]:
-                                line.no_page_break = True
-            
-            elif isinstance(pg, VSpace):
-                lines = [Line(self.params.line_width, pg.height or self.params.line_height)]
-            
-            elif isinstance(pg, HLine):
-                lines = [HorizontalLine(self.params.line_width, self.params.line_height)]
+                        rendered = [Line(0, self.params.line_height)]
+
+                    rendered_rows[j].append(rendered)
+                    width = rendered[0].width if rendered else 0
+                    if width > max_width:
+                        max_width = width
                 
-            elif isinstance(pg, Eval):
-                pg.func(self.params)
-                lines = []
+                for rrow in rendered_rows:
+                    for line in rrow[i]:
+                        line.width = max_width
             
-            elif isinstance(pg, Subenvironment):
-                with self._stackFrame():
-                    lines = self.paragraphsToLines(pg.paragraphs)
-            
-            else:
-                print(f"Tuntematon kappaletyyppi {type(pg)}")
-                lines = []
-            
-            all_lines += lines
-
-        return all_lines
+            lines = []
+            for rrow in rendered_rows:
+                for i in range(max(len(c) for c in rrow)):
+                    column_lines: List[Line] = [c[i] if i < len(c) else Line(c[0].width if c else 0, self.params.line_height) for c in rrow]
+                    lines.append(ColumnLine(column_lines, self.params.column_gap, indent=indent))
+                    lines[-1].no_page_break = pg.no_page_break
+        
+        return lines
+    
+    def paragraphStyle(self, pg: Paragraph) -> Tuple[int, Style]:
+        if pg.type != "text":
+            level, font_size, line_height, text_align = TITLES[pg.type]
+            return level, self.params.style(font_size, line_height, text_align)
+        
+        return -1, self.params.style()
+    
+    def measureColumns(self, pg: Table) -> Tuple[np.ndarray, np.ndarray]:
+        num_columns = max(len(row) for row in pg.rows)
+        mins = np.zeros(num_columns)
+        maxs = np.zeros(num_columns)
+        for i in range(num_columns):
+            for row in pg.rows:
+                if i < len(row):
+                    cell_min, cell_max = self.measureItem(row[i])
+                    mins[i] = max(mins[i], cell_min)
+                    maxs[i] = max(maxs[i], cell_max)
+        
+        return mins, maxs
+    
+    def measureItem(self, pg: DocumentObj) -> Tuple[float, float]:
+        # Palauttaa kappaleen pienimmän ja suurimman leveyden: pisimmän sanan ja rivittämättömän tekstin leveyden
+        if isinstance(pg, Paragraph):
+            with self._styleFrame(self.paragraphStyle(pg)[1]):
+                min_width = 0.0
+                max_width = 0.0
+                for text in pg.text.split("\n"):
+                    if text.strip() == "":
+                        continue
+                    
+                    # Sama vertailu kuin rivityksessä, jotta luonnollisella leveydellä teksti mahtuu yhdelle riville
+                    words, _ = self.measureText(text)
+                    wsum = 0.0
+                    for k, word in enumerate(words):
+                        min_width = max(min_width, word.width)
+                        max_width = max(max_width, wsum + k * self.style.min_word_gap + word.width)
+                        wsum += word.width
+                
+                return min_width, max_width
+        
+        elif isinstance(pg, Table):
+            with self._stackFrame():
+                mins, maxs = self.measureColumns(pg)
+                gaps = self.params.column_gap * (len(mins) - 1)
+                return float(mins.sum()) + gaps, float(maxs.sum()) + gaps
+        
+        elif isinstance(pg, Subenvironment):
+            with self._stackFrame():
+                sizes = [self.measureItem(item) for item in pg.paragraphs]
+                return max((a for a, _ in sizes), default=0.0), max((b for _, b in sizes), default=0.0)
+        
+        elif isinstance(pg, (VSpace, HLine)):
+            # Täyttävät koko käytettävissä olevan leveyden
+            return 0.0, inf
+        
+        elif isinstance(pg, Eval):
+            pg.func(self.params)
+        
+        return 0.0, 0.0
 
     def createLayout(self, text: str) -> pango.Layout:
-        layout = pangocairo.create_layout(self.context)
-        layout.set_font_description(self._getFont())
-        layout.set_markup(fixMarkup(text))
-        return layout
+        return createLayout(self.context, self._getFont(), fixMarkup(text))
     
     def textToLines(self, text: str, **args) -> List[Line]:
         return list(itertools.chain(*[self.textWithoutNewlinesToLines(t, **args) for t in text.split("\n")]))
     
     def textWithoutNewlinesToLines(self, text: str, equal_widths=True, hyphenate=True) -> List[Line]:
         if text.strip() == "":
-            return [Line(0, self.params.line_height)]
+            return [Line(0, self.style.line_height)]
 
         ans = []
-        layouts = [(word, self.createLayout(word)) for word in text.split(" ")]
+        hyphenation = self.hyphenation.get(self.params) if hyphenate else None
+        words, shape = self.measureText(text)
         
-        while layouts:
-            surf = cairo.RecordingSurface(cairo.CONTENT_ALPHA, None)
-            context = cairo.Context(surf)
-            context.set_source_rgb(0, 0, 0)
-
+        while words:
             i = 0
-            il = []
+            il: List[Word] = []
             wsum = 0
-            for word, layout in layouts:
-                _, _, w, h = getLayoutExtent(layout)
-                w, h = self._fixXY(w, h)
-                if wsum + len(il) * self.params.min_word_gap + w > self.params.line_width:
-                    if hyphenate and voikko and "-" not in word:
-                        syllables = re.split(r"-", voikko.hyphenate(word))
-                        for j in range(len(syllables), 0, -1):
-                            text = "".join(syllables[0:j])
-                            if len(stripMarkup(text)) <= 1:
-                                break
-
-                            new_l = self.createLayout(text + "-")
-                            _, _, new_w, new_h = getLayoutExtent(new_l)
-                            new_w, new_h = self._fixXY(new_w, new_h)
-                            if wsum + len(il) * self.params.min_word_gap + new_w <= self.params.line_width:
-                                il.append(new_l)
-                                wsum += new_w
-                                layout.set_markup(fixMarkup("".join(syllables[j:])))
-                                break
-
-                    word_gap = (self.params.line_width - wsum) / (len(il) - 1) if len(il) > 1 else self.params.min_word_gap
+            for word in words:
+                if wsum + len(il) * self.style.min_word_gap + word.width > self.style.line_width:
+                    if hyphenation and "-" not in word.text:
+                        syllables = re.split(r"-", hyphenation.hyphenate(word.text))
+                        split = self.splitSyllables(syllables, wsum + len(il) * self.style.min_word_gap, shape)
+                        if split:
+                            new_word, rest = split
+                            il.append(new_word)
+                            wsum += new_word.width
+                            words[i] = rest
+
+                    word_gap = (self.style.line_width - wsum) / (len(il) - 1) if len(il) > 1 else self.style.min_word_gap
                     break
 
-                il.append(layout)
-                wsum += w
+                il.append(word)
+                wsum += word.width
                 i += 1
             
             else:
-                word_gap = self.params.min_word_gap
+                word_gap = self.style.min_word_gap
             
-            if i == 0:
-                _, _, w, h = getLayoutExtent(layouts[0][1])
-                w, h = self._fixXY(w, h)
-                il.append(layouts[0][1])
-                wsum = w
+            if not il:
+                il.append(words[0])
+                wsum = words[0].width
                 i += 1
 
             x = 0
             
-            if self.params.text_align == "center":
-                word_gap = self.params.min_word_gap
-                x = (self.params.line_width - wsum - len(il) * self.params.min_word_gap) / 2
+            if self.style.text_align == "center":
+                word_gap = self.style.min_word_gap
+                x = (self.style.line_width - wsum - len(il) * self.style.min_word_gap) / 2
 
             width = -word_gap
-            height = self.params.line_height
-            for l in il:
-                context.translate(*self._fixXY(x, 0))
-                #pangocairo.update_context(context, l.get_context())
-                pangocairo.show_layout(context, l)
-                context.translate(*self._fixXY(-x, 0))
-                _, _, w, h = getLayoutExtent(l)
-                w, h = self._fixXY(w, h)
-                x += word_gap + w
-                width += word_gap + w
-                if h > height:
-                    height = h
-            
-            if self.params.text_align == "center":
-                width = self.params.line_width
-
-            del layouts[:i]
-
-            if height != self.params.line_height:
+            height = self.style.line_height
+            xs = []
+            for word in il:
+                xs.append(x)
+                x += word_gap + word.width
+                width += word_gap + word.width
+                if word.height > height:
+                    height = word.height
+            
+            if self.style.text_align == "center":
+                width = self.style.line_width
+
+            if height != self.style.line_height:
                 print(f"Liian pitkä rivi: {height} {repr(text)}")
 
-            ans.append(TextLine(surf, width, height, indent=self.params.indent))
+            # Sarkainasettelu edellyttää, että sanojen välissä on selvä rako. Molemmat piirtotavat
+            # valitsevat asettelun samoin, jotta välimuistit ja työprosessit eivät muuta tulostetta.
+            tabs = shape and xs[0] >= 0 and (len(il) == 1 or word_gap >= 1)
+            if self.direct_paint:
+                ans.append(WordLine([(x, fixMarkup(word.text)) for word, x in zip(il, xs)], self.style.font, width, height, tabs, indent=self.style.indent))
+            
+            else:
+                surf = cairo.RecordingSurface(cairo.CONTENT_ALPHA, None)
+                context = cairo.Context(surf)
+                context.set_source_rgb(0, 0, 0)
+                if tabs:
+                    pangocairo.show_layout(context, self.createTabLayout([word.text for word in il], xs))
+                
+                else:
+                    for word, x in zip(il, xs):
+                        context.translate(*self._fixXY(x, 0))
+                        pangocairo.show_layout(context, self.getLayout(word.text))
+                        context.translate(*self._fixXY(-x, 0))
+                
+                ans.append(TextLine(surf, width, height, indent=self.style.indent))
+
+            del words[:i]
         
         # Aseta rivien leveystiedot yhdenmukaiseksi sarakealgoritmia varten
         if equal_widths:
@@ -399,57 +1017,176 @@ class draw:
         
         return ans
     
-    def calculatePageBreaks(self, lines: List[Line]):
+    def measureText(self, text: str) -> Tuple[List[Word], bool]:
+        shape = self.params.shape_paragraphs and self.page_direction in "^v" and "\t" not in text
+        if shape:
+            return self.shapeWords(text.split(" ")), True
+        
+        return [self.measureWord(word) for word in text.split(" ")], False
+    
+    def splitSyllables(self, syllables: List[str], used: float, shape: bool) -> Optional[Tuple[Word, Word]]:
+        # Valitaan pisin tavuista koottu alkuosa, joka mahtuu riville tavuviivan kanssa.
+        # Yhden kirjaimen alkuosia ei hyväksytä.
+        prefixes = list(itertools.accumulate(syllables))
+        candidates = [j for j in range(1, len(syllables)+1) if len(stripMarkup(prefixes[j-1])) > 1]
+        if not candidates:
+            return None
+        
+        def fits(j: int) -> Optional[Word]:
+            new_word = self.measureWord(prefixes[j-1] + "-")
+            if used + new_word.width <= self.style.line_width:
+                return new_word
+            
+            return None
+        
+        def split(j: int, new_word: Word) -> Tuple[Word, Word]:
+            return new_word, self.measureWord("".join(syllables[j:]))
+        
+        if self.page_direction in "^v" and not re.search(r"[\\\[\]{}]", prefixes[-1]):
+            # Alkuosien leveydet arvioidaan tavujen leveyksien summina, ja tarkasti mitataan vain ne
+            # ehdokkaat, joiden arvio on toleranssin sisällä rivin leveydestä
+            widths = self.shapeWords(syllables) if shape else [self.measureWord(syllable) for syllable in syllables]
+            hyphen = self.measureWord("-").width
+            estimates = list(itertools.accumulate(w.width for w in widths))
+            k = bisect.bisect_right([estimates[j-1] + hyphen for j in candidates], self.style.line_width - used + HYPHENATION_TOLERANCE * self.style.font_size)
+            for j in reversed(candidates[:k]):
+                new_word = fits(j)
+                if new_word:
+                    return split(j, new_word)
+            
+            return None
+
+        # Merkintäkoodeja sisältävien sanojen tavuja ei voi mitata erikseen, joten
+        # mahtuvista alkuosista pisin haetaan puolitushaulla
+        lo, hi = 0, len(candidates)
+        best = None
+        while lo < hi:
+            mid = (lo + hi) // 2
+            new_word = fits(candidates[mid])
+            if new_word:
+                best = candidates[mid], new_word
+                lo = mid + 1
+            
+            else:
+                hi = mid
+        
+        return split(*best) if best else None
+    
+    def measureWord(self, text: str) -> Word:
+        key = (*self.style.font, text)
+        entry = self.metrics.get(key)
+        if entry is None:
+            layout = self.createLayout(text)
+            _, _, w, h = getLayoutExtent(layout)
+            entry = Metrics(w, h, layout)
+            self.metrics.put(key, entry)
+        
+        return Word(text, *self._fixXY(entry.width, entry.height))
+    
+    def getLayout(self, text: str) -> pango.Layout:
+        key = (*self.style.font, text)
+        entry = self.metrics.get(key)
+        if entry is None or entry.layout is None:
+            layout = self.createLayout(text)
+            _, _, w, h = getLayoutExtent(layout)
+            entry = Metrics(w, h, layout)
+            self.metrics.put(key, entry)
+        
+        return entry.layout
+    
+    def shapeWords(self, texts: List[str]) -> List[Word]:
+        # Koko kappale muotoillaan yhdellä Pango-asettelulla, ja sanojen leveydet luetaan klusterien
+        # sijainneista ja korkeudet niiden ajojen (run) loogisista laajuuksista, joihin sana kuuluu
+        font_key = self.style.font
+        keys = [(*font_key, text) for text in texts]
+        cached = [self.metrics.peek(key) for key in keys]
+        if all(cached):
+            for key, entry in zip(keys, cached):
+                self.metrics.record(key, entry)
+            
+            return [Word(text, entry.width, entry.height) for text, entry in zip(texts, cached)]
+
+        layout = newLayout(self.context)
+        layout.set_font_description(self._getFont())
+        layout.set_markup(" ".join(fixMarkup(text) for text in texts))
+        plain = layout.get_text().encode("utf-8")
+        plain_words = plain.split(b" ")
+        if len(plain_words) != len(texts):
+            return [self.measureWord(text) for text in texts]
+
+        xs = {}
+        layout_iter = layout.get_iter()
+        while True:
+            xs[layout_iter.get_index()] = layout_iter.get_cluster_extents()[1].x
+            if not layout_iter.next_cluster():
+                break
+        
+        _, logical = layout.get_extents()
+        xs[len(plain)] = logical.x + logical.width
+
+        runs = []
+        layout_iter = layout.get_iter()
+        while True:
+            run = layout_iter.get_run()
+            if run is not None:
+                _, run_logical = layout_iter.get_run_extents()
+                runs.append((run.item.offset, run.item.offset + run.item.length, run_logical.y, run_logical.y + run_logical.height))
+            
+            if not layout_iter.next_run():
+                break
+        
+        ans = []
+        start = 0
+        for text, key, plain_word, entry in zip(texts, keys, plain_words, cached):
+            end = start + len(plain_word)
+            if entry:
+                self.metrics.record(key, entry)
+                ans.append(Word(text, entry.width, entry.height))
+            
+            elif start not in xs or end not in xs:
+                # measureWord kirjaa ohituksen itse
+                ans.append(self.measureWord(text))
+            
+            else:
+                extents = [(top, bottom) for a, b, top, bottom in runs if a < end and start < b or a <= start < b]
+                if extents:
+                    height = max(bottom for _, bottom in extents) - min(top for top, _ in extents)
+                else:
+                    height = logical.height
+                
+                entry = Metrics(pango.units_to_double(xs[end] - xs[start]), pango.units_to_double(height))
+                self.metrics.record(key, None)
+                self.metrics.put(key, entry)
+                ans.append(Word(text, entry.width, entry.height))
+            
+            start = end + 1
+        
+        return ans
+    
+    def createTabLayout(self, texts: List[str], xs: List[float]) -> pango.Layout:
+        return createTabLayout(self.context, self._getFont(), [fixMarkup(text) for text in texts], xs)
+    
+    def calculatePageBreaks(self, metrics: LineMetrics):
+        start = time.perf_counter()
         if not self.params.smart_page_breaks:
             h = 0
             ans = []
-            for i, line in enumerate(lines):
-                h += line.height
+            for i, height in enumerate(metrics.heights):
+                h += height
                 if h > self.params.page_height:
                     ans += [i]
                     h = 0
-            
-            return ans
-
-        badness = np.full((len(lines)+1, len(lines)+1), inf)
-        for i in irange(0, len(lines) - 1):
-            for j in irange(i, len(lines)):
-                badness[i, j] = (self.params.page_height - sum(l.height for l in stripGaps(lines[i:j+1]))) ** 3
-                
-                if badness[i, j] < 0:
-                    badness[i, j] = inf
-                
-                elif lines[i].no_page_break:
-                    badness[i, j] += 1e50
-
-                elif j == len(lines):
-                    badness[i, j] = 0
-        
-        scores = np.full((len(lines)+1, len(lines)), inf)
-        bps = {}
-        j = len(lines)
-        for n in tqdm(irange(0, len(lines) - 1)):
-            for i in irange(len(lines) - 1, 0, -1):
-                if n == 0:
-                    scores[i, n] = inf
-                    bps[(i, n)] = []
-                
-                else:
-                    min_score = badness[i, j]
-                    min_bps = []
-                    for x in irange(i+1, j):
-                        score = scores[x, n-1] + badness[i, x-1]
-                        if score < min_score:
-                            min_score = score
-                            min_bps = [x] + bps[(x, n-1)]
-                    
-                    scores[i, n] = min_score
-                    bps[(i, n)] = min_bps
         
-        return bps[(0, len(lines) - 1)]
+        else:
+            ans = optimalPageBreaks(metrics, self.params.page_height)
+        
+        if self.stats:
+            self.stats.add("page_breaks", time.perf_counter() - start)
+        
+        return ans
     
-    def _getFont(self):
-        return self.params.fonts[self.params.font]
+    def _getFont(self) -> pango.FontDescription:
+        return fontFromKey(self.style.font)
     
     def _stackFrame(self):
         class C:
@@ -462,6 +1199,18 @@ class draw:
         
         return C()
     
+    def _styleFrame(self, style: Style):
+        # Kappaleen tyyli vaihdetaan kopioimatta parametreja
+        class C:
+            def __enter__(_self, *args):
+                _self.previous = self.style
+                self.style = style
+            
+            def __exit__(_self, *args):
+                self.style = _self.previous
+        
+        return C()
+    
     def _fixXY(self, x: float, y: float) -> Tuple[float, float]:
         if self.page_direction in "^v":
             return x, y
@@ -469,6 +1218,92 @@ class draw:
         else:
             return y, x
 
+def pushTextGroup(context: cairo.Context):
+    # Teksti piirretään pelkkänä peittävyytenä ja maalataan mustalla kuten TextLine-rivien
+    # CONTENT_ALPHA-pinnoilta, joten merkintöjen värit jäävät pois kaikilla piirtotavoilla
+    context.push_group_with_content(cairo.CONTENT_ALPHA)
+
+def popTextGroup(context: cairo.Context):
+    pattern = context.pop_group()
+    context.set_source_rgb(0, 0, 0)
+    context.mask(pattern)
+
+# Luotujen Pango-asettelujen määrä tilastoja varten
+layout_count = 0
+
+def newLayout(context: cairo.Context) -> pango.Layout:
+    global layout_count
+    layout_count += 1
+    return pangocairo.create_layout(context)
+
+def createLayout(context: cairo.Context, font: pango.FontDescription, markup: str) -> pango.Layout:
+    layout = newLayout(context)
+    layout.set_font_description(font)
+    layout.set_markup(markup)
+    return layout
+
+def createTabLayout(context: cairo.Context, font: pango.FontDescription, markups: List[str], xs: List[float]) -> pango.Layout:
+    # Rivin sanat piirretään yhdellä asettelulla, jossa jokainen sana alkaa omasta sarkainkohdastaan
+    markup = "\t".join(markups)
+    stops = xs[1:]
+    if xs[0] != 0:
+        markup = "\t" + markup
+        stops = xs
+    
+    layout = newLayout(context)
+    layout.set_font_description(font)
+    tabs = pango.pango.pango_tab_array_new(len(stops), False)
+    for k, x in enumerate(stops):
+        pango.pango.pango_tab_array_set_tab(tabs, k, pango.pango.PANGO_TAB_LEFT, pango.units_from_double(x))
+    
+    pango.pango.pango_layout_set_tabs(layout.get_pointer(), tabs)
+    pango.pango.pango_tab_array_free(tabs)
+    layout.set_markup(markup)
+    return layout
+
+def renderDisplayList(dl: DisplayList, outfile: str):
+    # Piirtoon tarvitaan vain fontit ja merkinnät; asettelua ei lasketa uudelleen
+    surf = cairo.PDFSurface(outfile, dl.width, dl.height)
+    context = cairo.Context(surf)
+    context.rectangle(0, 0, dl.width, dl.height)
+    context.set_source_rgb(1, 1, 1)
+    context.fill()
+
+    fonts = [fontFromKey(font) for font in dl.fonts]
+    outlines: Dict[int, List[Outline]] = defaultdict(list)
+    for outline in dl.outlines:
+        outlines[outline.page].append(outline)
+
+    last_title = defaultdict(lambda: 0)
+    for page_number, ops in enumerate(dl.pages, start=1):
+        for outline in outlines[page_number]:
+            link = last_title[outline.level - 1]
+            last_title[outline.level] = surf.add_outline(link, outline.title, f"page={page_number} pos=[{outline.x} {outline.y}]")
+
+        for op in ops:
+            if isinstance(op, Rule):
+                context.set_source_rgb(op.gray, op.gray, op.gray)
+                context.move_to(op.x1, op.y1)
+                context.line_to(op.x2, op.y2)
+                context.stroke()
+                continue
+
+            context.save()
+            pushTextGroup(context)
+            context.translate(op.x, op.y)
+            if isinstance(op, TabRun):
+                pangocairo.show_layout(context, createTabLayout(context, fonts[op.font], [markup for _, markup in op.words], [x for x, _ in op.words]))
+
+            else:
+                pangocairo.show_layout(context, createLayout(context, fonts[op.font], op.markup))
+
+            popTextGroup(context)
+            context.restore()
+
+        surf.show_page()
+
+    surf.finish()
+
 def getLayoutExtent(layout: pango.Layout) -> Tuple[float, float, float, float]:
     e = layout.get_extents()
     return (
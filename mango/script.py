@@ -1,5 +1,7 @@
+import functools
 import re
-from typing import Callable, Dict, List, Literal, NamedTuple, Set, Union
+import time
+from typing import Callable, Dict, Iterator, List, Literal, NamedTuple, Optional, Set, Union
 
 
 TokenType = Literal["str", "float", "ident", "punct"]
@@ -10,15 +12,20 @@ class Token(NamedTuple):
     type: TokenType
     text: str
 
-class TokenList(NamedTuple):
+class TokenList:
     tokens: List[Token]
+    pos: int
+
+    def __init__(self, tokens: List[Token]):
+        self.tokens = tokens
+        self.pos = 0
 
     def checkEOF(self):
-        if not self.tokens:
+        if not self.hasNext():
             raise RuntimeError("Unexpected EOF")
 
     def peek(self, n: int = 0):
-        return self.tokens[n]
+        return self.tokens[self.pos + n]
     
     def isNext(self, type: TokenType, *texts: str, n: int = 0):
         if not self.hasNext(n):
@@ -34,101 +41,61 @@ class TokenList(NamedTuple):
         return self.pop()
     
     def pop(self):
-        return self.tokens.pop(0)
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
     
     def hasNext(self, n: int = 0):
-        return len(self.tokens) > n
-
-def lexer(text: str) -> TokenList:
-    current_ident = ""
-    tokens: List[Token] = []
+        return len(self.tokens) - self.pos > n
+
+# Merkkijonot päättyvät aloitusmerkkiinsä, paitsi |-merkkijono rivinvaihtoon
+SCRIPT_TOKEN_RE = re.compile(r"""
+    (?P<newline>\n)
+    | (?P<space>[^\S\n]+)
+    | (?P<punct><=|>=|!=|==|[(){};,+\-*/%=<>!:])
+    | (?P<str>`[^`]*`|'[^']*'|"[^"]*"|\|[^\n]*\n)
+    | (?P<ident>[^\s(){};,+\-*/%=<>!:`'"|]+)
+""", re.X)
+
+FLOAT_RE = re.compile(r"[0-9]+(\.[0-9]+)?(e[0-9]+)?")
+
+def tokenize(text: str) -> Iterator[Token]:
+    # Sarakkeet lasketaan kuten aiemmin: välimerkin ja merkkijonon sarake on sen ensimmäisen merkin
+    # jälkeinen kohta, ja tunnisteen sarake sen ensimmäisen merkin jälkeinen kohta, paitsi tiedoston lopussa.
     line = 1
-    col = 1
-
-    def pushIdent():
-        nonlocal current_ident
-        if current_ident:
-            if re.fullmatch(r"[0-9]+(\.[0-9]+)?(e[0-9]+)?", current_ident):
-                tokens.append(Token(line, col-len(current_ident), "float", current_ident))
-            
-            else:
-                tokens.append(Token(line, col-len(current_ident), "ident", current_ident))
-            
-            current_ident = ""
-    
-    def parseString(start, end):
-        nonlocal line, col
-        string = ""
-        startcol = col
-        char = chars.pop(0); col += 1
-        while char != end:
-            if char == "\n":
-                line += 1
-                col = 1
-            
-            string += char
-            char = chars.pop(0); col += 1
-        else:
-            if char == "\n":
-                line += 1
-                col = 1
+    line_start = 0
+    pos = 0
+    while pos < len(text):
+        match = SCRIPT_TOKEN_RE.match(text, pos)
+        if match is None:
+            raise RuntimeError("Unexpected EOF")
         
-        tokens.append(Token(line, startcol, "str", string))
-
-    chars = list(text)
-    while chars:
-        char = chars.pop(0); col += 1
-        if char == "\n":
-            pushIdent()
+        kind = match.lastgroup
+        start, pos = match.span()
+        if kind == "newline":
             line += 1
-            col = 1
-        
-        elif char.isspace():
-            pushIdent()
-        
-        elif char in "(){};,+-*/%=<>!:":
-            pushIdent()
-            op = char
-            if chars:
-                if char == "<" and chars[0] == "=":
-                    op = "<="
-                    chars.pop(0); col += 1
-                
-                elif char == ">" and chars[0] == "=":
-                    op = ">="
-                    chars.pop(0); col += 1
-                
-                elif char == "!" and chars[0] == "=":
-                    op = "!="
-                    chars.pop(0); col += 1
-                
-                elif char == "=" and chars[0] == "=":
-                    op = "=="
-                    chars.pop(0); col += 1
-
-            tokens.append(Token(line, col, "punct", op))
+            line_start = pos
         
-        elif char == "`":
-            pushIdent()
-            parseString("`", "`")
+        elif kind == "punct":
+            yield Token(line, pos - line_start + 1, "punct", match.group())
         
-        elif char == "'":
-            pushIdent()
-            parseString("'", "'")
-        
-        elif char == '"':
-            pushIdent()
-            parseString('"', '"')
-        
-        elif char == "|":
-            pushIdent()
-            parseString("|", "\n")
+        elif kind == "str":
+            col = start - line_start + 2
+            string = match.group()[1:-1]
+            newlines = match.group().count("\n")
+            if newlines:
+                line += newlines
+                line_start = start + match.group().rindex("\n") + 1
+            
+            yield Token(line, col, "str", string)
         
-        else:
-            current_ident += char
-    
-    pushIdent()
-    return TokenList(tokens)
+        elif kind == "ident":
+            ident = match.group()
+            col = start - line_start + (1 if pos == len(text) else 2)
+            yield Token(line, col, "float" if FLOAT_RE.fullmatch(ident) else "ident", ident)
+
+def lexer(text: str) -> TokenList:
+    return TokenList(list(tokenize(text)))
 
 ExprValue = Union[float, str, List["ExprValue"], None]
 
@@ -154,15 +121,84 @@ BUILTINS: Dict[str, Callable] = {
 class Frame(NamedTuple):
     functions: Dict[str, Callable]
 
-class Interpreter:
-    frames: List[Frame] = [Frame(BUILTINS.copy())]
+class ProfileEntry:
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+        # Rekursiivisten kutsujen aika lasketaan kokonaisaikaan vain uloimmasta kutsusta
+        self.active = 0
+
+class Profiler:
+    functions: Dict[str, ProfileEntry]
+    lines: Dict[int, ProfileEntry]
+
+    def __init__(self, source: str = ""):
+        self.source = source.split("\n")
+        self.functions = {}
+        self.lines = {}
+        self.stack: List[List[float]] = []
+
+    def enter(self, func: str, line: int):
+        self.functions.setdefault(func, ProfileEntry()).active += 1
+        self.lines.setdefault(line, ProfileEntry()).active += 1
+        self.stack.append([time.perf_counter(), 0.0])
+
+    def exit(self, func: str, line: int):
+        start, children = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        if self.stack:
+            self.stack[-1][1] += elapsed
+        
+        for entry in (self.functions[func], self.lines[line]):
+            entry.calls += 1
+            entry.self_time += elapsed - children
+            entry.active -= 1
+            if entry.active == 0:
+                entry.total_time += elapsed
+    
+    def lineText(self, line: int) -> str:
+        return self.source[line-1].strip() if 0 < line <= len(self.source) else ""
+
+    def toJson(self) -> dict:
+        def entries(stats: Dict, key: str) -> List[dict]:
+            return [
+                {key: name, "calls": e.calls, "total_time": e.total_time, "self_time": e.self_time}
+                for name, e in sorted(stats.items(), key=lambda item: -item[1].self_time)
+            ]
+        
+        lines = entries(self.lines, "line")
+        for entry in lines:
+            entry["text"] = self.lineText(entry["line"])
+        
+        return {"functions": entries(self.functions, "function"), "lines": lines}
+
+    def printTable(self, limit: int = 20):
+        print(f"{'Funktio':<30} {'Kutsuja':>10} {'Kokonaisaika':>14} {'Oma aika':>10}")
+        for name, e in sorted(self.functions.items(), key=lambda item: -item[1].self_time)[:limit]:
+            print(f"{name[:30]:<30} {e.calls:>10} {e.total_time:>13.4f}s {e.self_time:>9.4f}s")
+        
+        print()
+        print(f"{'Rivi':<30} {'Kutsuja':>10} {'Kokonaisaika':>14} {'Oma aika':>10}")
+        for line, e in sorted(self.lines.items(), key=lambda item: -item[1].self_time)[:limit]:
+            label = f"{line}: {self.lineText(line)}"
+            print(f"{label[:30]:<30} {e.calls:>10} {e.total_time:>13.4f}s {e.self_time:>9.4f}s")
 
-    def getFunctions(self):
-        ans = {}
-        for frame in self.frames:
-            ans.update(frame.functions)
+class Interpreter:
+    frames: List[Frame]
+    profiler: Optional[Profiler]
+
+    def __init__(self, profiler: Optional[Profiler] = None):
+        self.frames = [Frame(BUILTINS.copy())]
+        self.profiler = profiler
+
+    def lookup(self, name: str) -> Optional[Callable]:
+        for frame in reversed(self.frames):
+            func = frame.functions.get(name)
+            if func is not None:
+                return func
         
-        return ans
+        return None
     
     def pushFrame(self):
         self.frames.append(Frame({}))
@@ -170,69 +206,137 @@ class Interpreter:
     def popFrame(self):
         self.frames.pop()
 
+# Käännetty lauseke on funktio, joka saa tulkin parametrinaan, jotta sama käännös kelpaa usealle tulkille
+Code = Callable[[Interpreter], ExprValue]
+
+def constant(value: ExprValue) -> Callable[[], ExprValue]:
+    return lambda: value
+
 class BlockTree(NamedTuple):
     exprs: List["ExprTree"]
 
     def eval(self, itpt: Interpreter) -> ExprValue:
-        ans = []
-        for expr in self.exprs:
-            v = expr.eval(itpt)
-            if v is not None:
-                ans.append(v)
+        return self.compile(None)(itpt)
+
+    def compile(self, names: Optional[Set[str]], profile: bool = False) -> Code:
+        codes = [expr.compile(names, profile) for expr in self.exprs]
+
+        def block(itpt: Interpreter) -> ExprValue:
+            ans = []
+            for code in codes:
+                v = code(itpt)
+                if v is not None:
+                    ans.append(v)
+            
+            return ans
         
-        return ans
+        return block
 
 class FunctionCallTree(NamedTuple):
     func: str
     args: List["ExprTree"]
+    line: int = 0
 
     def eval(self, itpt: Interpreter) -> ExprValue:
-        if len(self.args) == 3 and self.func == "if":
-            cond = self.args[0].eval(itpt)
-            if cond:
-                return self.args[1].eval(itpt)
+        return self.compile(None)(itpt)
+
+    def compile(self, names: Optional[Set[str]], profile: bool = False) -> Code:
+        code = self.compileCall(names, profile)
+        if not profile:
+            return code
+        
+        func = self.func
+        line = self.line
+
+        def profiled(itpt: Interpreter) -> ExprValue:
+            profiler = itpt.profiler
+            if profiler is None:
+                return code(itpt)
             
-            else:
-                return self.args[2].eval(itpt)
+            profiler.enter(func, line)
+            try:
+                return code(itpt)
+            finally:
+                profiler.exit(func, line)
         
-        elif len(self.args) == 3 and self.func == "for":
-            varname = self.args[0].eval(itpt)
-            items = self.args[1].eval(itpt)
-            ans = []
-            for item in list(items):
-                itpt.pushFrame()
-                itpt.frames[-1].functions[varname] = lambda: item
-                v = self.args[2].eval(itpt)
-                if v is not None:
-                    ans.append(v)
+        return profiled
+
+    def compileCall(self, names: Optional[Set[str]], profile: bool) -> Code:
+        # names sisältää nimet, jotka def tai for voi määritellä. Muut nimet haetaan suoraan
+        # globaalista kehyksestä, ja sisäänrakennetut funktiot sidotaan jo käännettäessä.
+        # Jos nimiä ei tunneta (None), jokainen nimi haetaan kaikista kehyksistä.
+        func = self.func
+        args = [a.compile(names, profile) for a in self.args]
+        if len(args) == 3 and func == "if":
+            cond, then, otherwise = args
+            return lambda itpt: then(itpt) if cond(itpt) else otherwise(itpt)
+        
+        elif len(args) == 3 and func == "for":
+            varname, items, body = args
+
+            def forLoop(itpt: Interpreter) -> ExprValue:
+                name = varname(itpt)
+                ans = []
+                for item in list(items(itpt)):
+                    itpt.pushFrame()
+                    itpt.frames[-1].functions[name] = constant(item)
+                    v = body(itpt)
+                    if v is not None:
+                        ans.append(v)
+                    
+                    itpt.popFrame()
                 
-                itpt.popFrame()
+                return ans
             
-            return ans
+            return forLoop
         
-        elif len(self.args) == 3 and self.func == "def":
-            funcname = self.args[0].eval(itpt)
-            params = self.args[1].eval(itpt)
-            body = self.args[2]
-
-            def execFunc(*args):
-                itpt.pushFrame()
-                for param, arg in zip(params, args):
-                    itpt.frames[-1].functions[param] = lambda: arg
+        elif len(args) == 3 and func == "def":
+            funcname, params, body = args
+
+            def define(itpt: Interpreter) -> ExprValue:
+                name = funcname(itpt)
+                param_names = params(itpt)
+
+                def execFunc(*values):
+                    itpt.pushFrame()
+                    for param, value in zip(param_names, values):
+                        itpt.frames[-1].functions[param] = constant(value)
+                    
+                    v = body(itpt)
+                    itpt.popFrame()
+                    return v
                 
-                v = body.eval(itpt)
-                itpt.popFrame()
-                return v
+                itpt.frames[-1].functions[name] = execFunc
+                return None
             
-            itpt.frames[-1].functions[funcname] = execFunc
-            return None
+            return define
+        
+        if names is not None and func not in names:
+            if func in BUILTINS:
+                builtin = BUILTINS[func]
+                if len(args) == 2:
+                    a, b = args
+                    return lambda itpt: builtin(a(itpt), b(itpt))
+                
+                return lambda itpt: builtin(*[a(itpt) for a in args])
+
+            def callGlobal(itpt: Interpreter) -> ExprValue:
+                f = itpt.frames[0].functions.get(func)
+                if f is None:
+                    raise RuntimeError(f"Unknown function {func}")
+                
+                return f(*[a(itpt) for a in args])
+            
+            return callGlobal
 
-        functions = itpt.getFunctions()
-        if self.func in functions:
-            return functions[self.func](*[a.eval(itpt) for a in self.args])
+        def call(itpt: Interpreter) -> ExprValue:
+            f = itpt.lookup(func)
+            if f is None:
+                raise RuntimeError(f"Unknown function {func}")
+            
+            return f(*[a(itpt) for a in args])
         
-        else:
-            raise RuntimeError(f"Unknown function {self.func}")
+        return call
 
 class FloatTree(NamedTuple):
     value: float
@@ -240,12 +344,20 @@ class FloatTree(NamedTuple):
     def eval(self, _itpt: Interpreter) -> ExprValue:
         return self.value
 
+    def compile(self, _names: Optional[Set[str]], _profile: bool = False) -> Code:
+        value = self.value
+        return lambda _itpt: value
+
 class StringTree(NamedTuple):
     value: str
 
     def eval(self, _itpt: Interpreter) -> ExprValue:
         return self.value
 
+    def compile(self, _names: Optional[Set[str]], _profile: bool = False) -> Code:
+        value = self.value
+        return lambda _itpt: value
+
 ExprTree = Union[FunctionCallTree, FloatTree, StringTree, BlockTree]
 
 def parseBlock(tokens: TokenList) -> BlockTree:
@@ -270,8 +382,8 @@ def parseOperatorExpr(tokens: TokenList, operators: List[Set[str]]) -> ExprTree:
     
     ans = parseOperatorExpr(tokens, operators[1:])
     while tokens.hasNext() and tokens.peek().type == "punct" and tokens.peek().text in operators[0]:
-        op = tokens.pop().text
-        ans = FunctionCallTree(op, [ans, parseOperatorExpr(tokens, operators[1:])])
+        op = tokens.pop()
+        ans = FunctionCallTree(op.text, [ans, parseOperatorExpr(tokens, operators[1:])], op.line)
     
     return ans
 
@@ -291,7 +403,8 @@ def parsePrimaryExpr(tokens: TokenList) -> ExprTree:
         return StringTree(tokens.pop().text)
     
     elif tokens.peek().type == "ident":
-        func = tokens.pop().text
+        func_token = tokens.pop()
+        func = func_token.text
         args = []
         if tokens.isNext("punct", "("):
             tokens.pop()
@@ -309,7 +422,40 @@ def parsePrimaryExpr(tokens: TokenList) -> ExprTree:
                 tokens.pop()
                 args.append(parseExpr(tokens))
         
-        return FunctionCallTree(func, args)
+        return FunctionCallTree(func, args, func_token.line)
     
     else:
-        raise RuntimeError(f"Unexpected token {repr(tokens.pop())}, expected expression")
\ No newline at end of file
+        raise RuntimeError(f"Unexpected token {repr(tokens.pop())}, expected expression")
+
+def definedNames(tree: ExprTree) -> Optional[Set[str]]:
+    # Kerää nimet, jotka for-silmukat ja def-määrittelyt voivat sitoa. Jos jokin nimi
+    # lasketaan vasta ajon aikana, palautetaan None.
+    names: Set[str] = set()
+
+    def visit(tree: ExprTree) -> bool:
+        if isinstance(tree, BlockTree):
+            return all(visit(expr) for expr in tree.exprs)
+        
+        elif isinstance(tree, FunctionCallTree):
+            if len(tree.args) == 3 and tree.func in {"for", "def"}:
+                if not isinstance(tree.args[0], StringTree):
+                    return False
+                
+                names.add(tree.args[0].value)
+                if tree.func == "def":
+                    params = tree.args[1]
+                    if not isinstance(params, BlockTree) or not all(isinstance(p, StringTree) for p in params.exprs):
+                        return False
+                    
+                    names.update(p.value for p in params.exprs)
+            
+            return all(visit(arg) for arg in tree.args)
+        
+        return True
+    
+    return names if visit(tree) else None
+
+@functools.lru_cache(maxsize=16)
+def compileScript(code: str, profile: bool = False) -> Code:
+    tree = parseBlock(lexer(code))
+    return tree.compile(definedNames(tree), profile)
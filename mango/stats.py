@@ -0,0 +1,111 @@
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+STAGES = ["parse", "layout", "page_breaks", "drawing"]
+
+T = TypeVar("T")
+
+class ChapterStats:
+    def __init__(self):
+        self.index = 0
+        self.seconds: Dict[str, float] = dict.fromkeys(STAGES, 0.0)
+        self.counters: Dict[str, int] = {}
+        self.lines = 0
+        self.pages = 0
+        self.cached = False
+
+    def metricsHitRate(self) -> float:
+        hits = self.counters.get("metrics_hits", 0)
+        total = hits + self.counters.get("metrics_misses", 0)
+        return hits / total if total else 0.0
+
+    def toJson(self) -> dict:
+        return {
+            "chapter": self.index + 1,
+            "seconds": self.seconds,
+            "counters": self.counters,
+            "metrics_hit_rate": self.metricsHitRate(),
+            "lines": self.lines,
+            "pages": self.pages,
+            "cached": self.cached,
+        }
+
+class Stats:
+    # Kirjaa vaiheiden ajat ja laskurit luvuittain. Laskurit ovat piirtäjän kumulatiivisia lukuja,
+    # joten luvun alussa otetaan tilannevedos ja lopussa tallennetaan erotus.
+    chapters: List[ChapterStats]
+
+    def __init__(self):
+        # Lukuihin kuulumaton aika, esimerkiksi kerralla jäsennettävän dokumentin lukeminen
+        self.seconds: Dict[str, float] = dict.fromkeys(STAGES, 0.0)
+        self.chapters = []
+        self.current: Optional[ChapterStats] = None
+        self.start_counters: Dict[str, int] = {}
+        self.parse_times: Deque[float] = deque()
+
+    def timeParse(self, chapters: Iterable[T]) -> Iterator[T]:
+        # Luku kerrallaan luettavan dokumentin jäsennysaika kirjataan luvulle, kun sen piirto alkaa
+        it = iter(chapters)
+        while True:
+            start = time.perf_counter()
+            try:
+                chapter = next(it)
+            except StopIteration:
+                self.seconds["parse"] += time.perf_counter() - start
+                return
+
+            self.parse_times.append(time.perf_counter() - start)
+            yield chapter
+
+    def add(self, stage: str, seconds: float):
+        (self.current.seconds if self.current else self.seconds)[stage] += seconds
+
+    def startChapter(self, counters: Dict[str, int]):
+        self.current = ChapterStats()
+        self.start_counters = counters
+
+    def endChapter(self, counters: Dict[str, int], elapsed: float, lines: int, pages: int, cached: bool):
+        chapter = self.current
+        chapter.counters = {name: value - self.start_counters.get(name, 0) for name, value in counters.items()}
+        # Rivit ladotaan sitä mukaa kuin sivunvaihtojen laskenta ja piirto niitä pyytävät
+        chapter.seconds["layout"] = max(0.0, elapsed - chapter.seconds["page_breaks"] - chapter.seconds["drawing"])
+        chapter.lines = lines
+        chapter.pages = pages
+        chapter.cached = cached
+        self.current = None
+        self.addChapter(chapter)
+
+    def addChapter(self, chapter: ChapterStats):
+        chapter.index = len(self.chapters)
+        if self.parse_times:
+            chapter.seconds["parse"] = self.parse_times.popleft()
+
+        self.chapters.append(chapter)
+
+    def totals(self) -> ChapterStats:
+        ans = ChapterStats()
+        ans.seconds = dict(self.seconds)
+        for chapter in self.chapters:
+            for stage, seconds in chapter.seconds.items():
+                ans.seconds[stage] += seconds
+
+            for name, value in chapter.counters.items():
+                ans.counters[name] = ans.counters.get(name, 0) + value
+
+            ans.lines += chapter.lines
+            ans.pages += chapter.pages
+
+        return ans
+
+    def toJson(self) -> dict:
+        total = self.totals().toJson()
+        del total["chapter"], total["cached"]
+        return {"total": total, "chapters": [chapter.toJson() for chapter in self.chapters]}
+
+    def printTable(self):
+        print(f"{'Luku':>6} " + " ".join(f"{stage:>12}" for stage in STAGES) + f" {'Asetteluja':>10} {'Osumat':>8} {'Rivejä':>8} {'Sivuja':>7}")
+        rows = [(str(chapter.index + 1), chapter) for chapter in self.chapters] + [("Yht.", self.totals())]
+        for label, chapter in rows:
+            times = " ".join(f"{chapter.seconds[stage]:>11.4f}s" for stage in STAGES)
+            print(f"{label:>6} {times} {chapter.counters.get('layouts', 0):>10} {chapter.metricsHitRate():>7.1%} {chapter.lines:>8} {chapter.pages:>7}")
@@ -0,0 +1,93 @@
+import random
+from math import inf
+
+from mango.render import LineMetrics, optimalPageBreaks
+
+def referencePageBreaks(heights, no_page_breaks, gaps, page_height):
+    # Alkuperäinen sivunvaihtoalgoritmi: jokainen sivun alku- ja loppukohta pisteytetään
+    n = len(heights)
+
+    def badness(i, j):
+        a = i
+        while a < n and gaps[a]:
+            a += 1
+
+        b = min(j, n - 1)
+        while b >= 0 and gaps[b]:
+            b -= 1
+
+        height = sum(heights[a:b+1]) if a <= b else 0
+        ans = (page_height - height) ** 3
+        if ans < 0:
+            return inf
+
+        elif no_page_breaks[i]:
+            return ans + 1e50
+
+        elif j == n:
+            return 0
+
+        return ans
+
+    scores = [inf] * (n + 1)
+    bps = [None] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        min_score = badness(i, n)
+        min_x = None
+        for x in range(i + 1, n):
+            score = scores[x] + badness(i, x - 1)
+            if score < min_score:
+                min_score = score
+                min_x = x
+
+        scores[i] = min_score
+        bps[i] = min_x
+
+    ans = []
+    i = 0
+    while n and bps[i] is not None:
+        i = bps[i]
+        ans.append(i)
+
+    return ans
+
+def randomMetrics(rng, n, negative):
+    heights = []
+    for _ in range(n):
+        # Kokonaisluvut pitävät summat tarkkoina, jolloin tasapisteet ratkeavat samoin
+        if negative and rng.random() < 0.1:
+            heights.append(float(-rng.randint(10, 200)))
+
+        else:
+            heights.append(float(rng.choice([12, 16, 16, 16, 20, 40, 300])))
+
+    no_page_breaks = [1 if rng.random() < 0.1 else 0 for _ in range(n)]
+    gaps = [1 if rng.random() < 0.2 else 0 for _ in range(n)]
+    return heights, no_page_breaks, gaps
+
+def check(heights, no_page_breaks, gaps, page_height):
+    metrics = LineMetrics()
+    metrics.heights.extend(heights)
+    metrics.no_page_breaks.extend(no_page_breaks)
+    metrics.gaps.extend(gaps)
+    assert optimalPageBreaks(metrics, page_height) == referencePageBreaks(heights, no_page_breaks, gaps, page_height)
+
+def test_matches_reference():
+    rng = random.Random(1)
+    for _ in range(200):
+        check(*randomMetrics(rng, rng.randint(0, 60), False), 400.0)
+
+def test_negative_vspace_matches_reference():
+    rng = random.Random(2)
+    for _ in range(200):
+        check(*randomMetrics(rng, rng.randint(1, 60), True), 400.0)
+
+def test_negative_vspace_allows_later_break():
+    # Kolmas rivi ei mahdu sivulle, mutta negatiivisen välin jälkeen neljä riviä mahtuu
+    heights = [150.0, 150.0, 150.0, -150.0, 100.0, 300.0]
+    check(heights, [0] * 6, [0] * 6, 400.0)
+    metrics = LineMetrics()
+    metrics.heights.extend(heights)
+    metrics.no_page_breaks.extend([0] * 6)
+    metrics.gaps.extend([0] * 6)
+    assert optimalPageBreaks(metrics, 400.0) == [5]